@@ -0,0 +1,61 @@
+"""
+Benchmark of building cat_df with rows_to_df for growing catalogue sizes.
+
+The time per event should stay flat as the catalogue grows (linear
+scaling), unlike the per-row DataFrame.loc appends it replaced.
+
+Usage:
+    python bench_catalogue.py [--sizes 10000 20000 ...] [--repeat N]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from catalogue import rows_to_df
+
+
+def synthetic_rows(count, seed=0):
+    rng = np.random.RandomState(seed)
+    qtimes = rng.randint(946684800, 1609459200, size=count)
+    lats = rng.uniform(-90, 90, size=count)
+    lons = rng.uniform(-180, 180, size=count)
+    depths = rng.uniform(0, 700, size=count)
+    mags = rng.uniform(1, 8, size=count)
+    rows = [('smi:local/event/%s' % i, int(qtimes[i]), lats[i], lons[i], depths[i], mags[i])
+            for i in range(count)]
+    # events without a magnitude
+    for i in range(0, count, 50):
+        rows[i] = rows[i][:5] + (None,)
+    return rows
+
+
+def time_rows_to_df(rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        rows_to_df(iter(rows), count=len(rows))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time rows_to_df on synthetic catalogues")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[7500, 15000, 30000, 60000, 120000])
+    parser.add_argument('--repeat', type=int, default=3, help="best of N runs per size")
+    args = parser.parse_args()
+
+    print("%10s %10s %14s" % ('events', 'seconds', 'us per event'))
+    per_event = []
+    for size in args.sizes:
+        elapsed = time_rows_to_df(synthetic_rows(size), args.repeat)
+        per_event.append(elapsed / size)
+        print("%10d %10.3f %14.2f" % (size, elapsed, 1e6 * elapsed / size))
+
+    # constant for linear scaling, growing with the size for quadratic
+    print("Per event time ratio, largest to smallest catalogue: %.2f" % (per_event[-1] / per_event[0]))
+
+
+if __name__ == '__main__':
+    main()
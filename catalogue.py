@@ -0,0 +1,462 @@
+"""
+Helpers to turn earthquake catalogues into the columnar cat_df DataFrame
+used by the event table and the map.
+"""
+import hashlib
+import json
+import os
+import time
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pandas as pd
+from obspy import read_events, UTCDateTime
+
+CAT_COLUMNS = ['event_id', 'qtime', 'lat', 'lon', 'depth', 'mag']
+
+# Parsed catalogue cache location and size limit (override with environment variables)
+CAT_CACHE_DIR = os.environ.get('QC_EVENTS_CAT_CACHE_DIR',
+                               os.path.join(os.path.expanduser("~"), ".qc_events", "catalogue_cache"))
+CAT_CACHE_MAX_BYTES = int(os.environ.get('QC_EVENTS_CAT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+
+
+def _event_row(event):
+    # Get quake origin info
+    origin_info = event.preferred_origin() or event.origins[0]
+
+    try:
+        mag_info = event.preferred_magnitude() or event.magnitudes[0]
+        magnitude = mag_info.mag
+    except IndexError:
+        # No magnitude for event
+        magnitude = None
+
+    return (str(event.resource_id.id).split('=')[1], int(origin_info.time.timestamp),
+            origin_info.latitude, origin_info.longitude,
+            origin_info.depth / 1000, magnitude)
+
+
+def rows_to_df(rows, count=-1):
+    """
+    Build cat_df from an iterable of (event_id, qtime, lat, lon, depth, mag)
+    tuples in a single pass, filling typed column arrays instead of appending
+    rows to a DataFrame
+    """
+    if count < 0:
+        rows = list(rows)
+        count = len(rows)
+
+    event_ids = np.empty(count, dtype=object)
+    qtimes = np.empty(count, dtype=np.int64)
+    lats = np.empty(count, dtype=np.float64)
+    lons = np.empty(count, dtype=np.float64)
+    depths = np.empty(count, dtype=np.float64)
+    mags = np.empty(count, dtype=np.float64)
+
+    _i = -1
+    for _i, (event_id, qtime, lat, lon, depth, mag) in enumerate(rows):
+        event_ids[_i] = event_id
+        qtimes[_i] = qtime
+        lats[_i] = lat
+        lons[_i] = lon
+        depths[_i] = depth
+        mags[_i] = np.nan if mag is None else mag
+
+    n = _i + 1
+    return pd.DataFrame({'event_id': event_ids[:n], 'qtime': qtimes[:n], 'lat': lats[:n],
+                         'lon': lons[:n], 'depth': depths[:n], 'mag': mags[:n]},
+                        columns=CAT_COLUMNS)
+
+
+def catalog_to_df(cat):
+    """
+    Extract the cat_df columns from an obspy Catalog
+    """
+    return rows_to_df((_event_row(event) for event in cat), count=len(cat))
+
+
+class QuakeMLStreamError(Exception):
+    """
+    Raised when the streaming reader meets QuakeML it does not understand
+    """
+    pass
+
+
+def _local_tag(elem):
+    # strip the xml namespace from a tag
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+def _child(elem, name):
+    for child in elem:
+        if _local_tag(child) == name:
+            return child
+    return None
+
+
+def _value(elem, name):
+    # QuakeML quantities are stored as <name><value>...</value></name>
+    quantity = _child(elem, name)
+    if quantity is None:
+        return None
+    value = _child(quantity, 'value')
+    if value is None or value.text is None:
+        return None
+    return value.text.strip()
+
+
+def _stream_event_row(event_elem):
+    public_id = event_elem.get('publicID', '')
+    if '=' not in public_id:
+        raise QuakeMLStreamError("Unexpected event publicID: %s" % public_id)
+
+    pref_origin_id = _child(event_elem, 'preferredOriginID')
+    pref_mag_id = _child(event_elem, 'preferredMagnitudeID')
+    pref_origin_id = None if pref_origin_id is None else (pref_origin_id.text or '').strip()
+    pref_mag_id = None if pref_mag_id is None else (pref_mag_id.text or '').strip()
+
+    origins = [child for child in event_elem if _local_tag(child) == 'origin']
+    magnitudes = [child for child in event_elem if _local_tag(child) == 'magnitude']
+
+    if len(origins) == 0:
+        raise QuakeMLStreamError("Event without an origin: %s" % public_id)
+
+    # preferred origin/magnitude or the first one listed
+    origin = next((o for o in origins if o.get('publicID') == pref_origin_id), origins[0])
+    magnitude = None
+    if len(magnitudes) > 0:
+        mag_elem = next((m for m in magnitudes if m.get('publicID') == pref_mag_id), magnitudes[0])
+        magnitude = _value(mag_elem, 'mag')
+
+    time = _value(origin, 'time')
+    latitude = _value(origin, 'latitude')
+    longitude = _value(origin, 'longitude')
+    depth = _value(origin, 'depth')
+    if None in (time, latitude, longitude, depth):
+        raise QuakeMLStreamError("Incomplete origin for event: %s" % public_id)
+
+    return (public_id.split('=')[1], int(UTCDateTime(time).timestamp),
+            float(latitude), float(longitude), float(depth) / 1000,
+            None if magnitude is None else float(magnitude))
+
+
+def iter_quakeml_rows(filename):
+    """
+    Incrementally walk a QuakeML file and yield one cat_df row per event
+
+    Only the preferred (or first) origin and magnitude of each event are
+    looked at, and every event element is discarded as soon as it has been
+    read so memory use does not grow with the size of the file.
+    """
+    context = ElementTree.iterparse(filename, events=('start', 'end'))
+    parent = None
+    root_checked = False
+
+    for action, elem in context:
+        tag = _local_tag(elem)
+        if action == 'start':
+            if not root_checked:
+                if tag != 'quakeml':
+                    raise QuakeMLStreamError("Not a QuakeML document: %s" % filename)
+                root_checked = True
+            elif tag == 'eventParameters':
+                parent = elem
+            continue
+
+        if tag == 'event':
+            yield _stream_event_row(elem)
+            # drop the parsed event so the tree does not grow
+            elem.clear()
+            if parent is not None:
+                parent.clear()
+
+
+def read_catalogue(filename):
+    """
+    Read a QuakeML file into cat_df, streaming the file where possible and
+    falling back to obspy's read_events for anything unusual
+    """
+    try:
+        return rows_to_df(iter_quakeml_rows(filename))
+    except (QuakeMLStreamError, ElementTree.ParseError, ValueError) as e:
+        print("Streaming QuakeML reader failed (%s), falling back to read_events" % e)
+        return catalog_to_df(read_events(filename))
+
+
+_WEEKDAYS = np.array(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+_MONTHS = np.array(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+
+
+def _zero_pad(values, width):
+    return np.char.zfill(values.astype(np.str_), width)
+
+
+def add_time_columns(cat_df):
+    """
+    Add the Q_time_str and julday columns to cat_df from the int64 qtime
+    column, matching UTCDateTime(qtime).ctime() and UTCDateTime(qtime).julday
+    """
+    qtime = cat_df['qtime'].values.astype(np.int64)
+    if len(qtime) == 0:
+        # np.char padding fails on zero-size arrays
+        cat_df['Q_time_str'] = np.array([], dtype=object)
+        cat_df['julday'] = np.array([], dtype=np.int64)
+        return cat_df
+
+    days, secs = np.divmod(qtime, 86400)
+
+    # build the date part once per distinct day
+    uniq_days, day_inv = np.unique(days, return_inverse=True)
+    dt_days = uniq_days.astype('M8[D]')
+    years = dt_days.astype('M8[Y]')
+    months = dt_days.astype('M8[M]')
+
+    year_no = years.astype(np.int64) + 1970
+    month_no = months.astype(np.int64) % 12
+    day_no = (dt_days - months.astype('M8[D]')).astype(np.int64) + 1
+    julday = (dt_days - years.astype('M8[D]')).astype(np.int64) + 1
+    # 1970-01-01 was a Thursday
+    weekday = (uniq_days + 3) % 7
+
+    date_prefix = np.char.add(np.char.add(_WEEKDAYS[weekday], ' '), _MONTHS[month_no])
+    date_prefix = np.char.add(np.char.add(date_prefix, ' '), np.char.rjust(day_no.astype(np.str_), 2))
+    year_suffix = np.char.add(' ', _zero_pad(year_no, 4))
+
+    hours, rem = np.divmod(secs, 3600)
+    minutes, seconds = np.divmod(rem, 60)
+    time_str = np.char.add(np.char.add(np.char.add(' ', _zero_pad(hours, 2)), ':'), _zero_pad(minutes, 2))
+    time_str = np.char.add(np.char.add(time_str, ':'), _zero_pad(seconds, 2))
+
+    q_time_str = np.char.add(np.char.add(date_prefix[day_inv], time_str), year_suffix[day_inv])
+
+    cat_df['Q_time_str'] = q_time_str.astype(object)
+    cat_df['julday'] = julday[day_inv]
+    return cat_df
+
+
+class CatalogueIndex(object):
+    """
+    Sorted indexes over the qtime, mag and depth columns of cat_df
+
+    Every range filter is resolved with two binary searches on the sorted
+    column, the matching rows are marked in a boolean mask and the masks of
+    all filters are intersected.
+    """
+
+    INDEXED_COLUMNS = ['qtime', 'mag', 'depth']
+
+    def __init__(self, cat_df):
+        self.cat_df = cat_df
+        self.n = len(cat_df)
+
+        self.order = {}
+        self.sorted_values = {}
+        self.n_valid = {}
+        for col in self.INDEXED_COLUMNS:
+            values = cat_df[col].values.astype(np.float64)
+            order = np.argsort(values, kind='mergesort')
+            self.order[col] = order
+            self.sorted_values[col] = values[order]
+            # NaNs are sorted to the end and never match a range
+            self.n_valid[col] = int(np.count_nonzero(~np.isnan(values)))
+
+    def range_positions(self, col, minval=None, maxval=None):
+        """
+        Return the slice of the sorted index for minval <= col <= maxval
+        """
+        sorted_values = self.sorted_values[col]
+        lo = 0 if minval is None else int(np.searchsorted(sorted_values, minval, side='left'))
+        hi = self.n_valid[col] if maxval is None else int(np.searchsorted(sorted_values, maxval, side='right'))
+        return lo, min(hi, self.n_valid[col])
+
+    def query(self, mintime=None, maxtime=None, minmag=None, maxmag=None, mindepth=None, maxdepth=None):
+        """
+        Return the sorted row positions in cat_df matching all the given
+        bounds (inclusive), bounds left as None are not applied
+        """
+        bounds = [('qtime', mintime, maxtime), ('mag', minmag, maxmag), ('depth', mindepth, maxdepth)]
+        ranges = [(col, self.range_positions(col, minval, maxval)) for col, minval, maxval in bounds
+                  if not (minval is None and maxval is None)]
+
+        if len(ranges) == 0:
+            return np.arange(self.n)
+
+        mask = None
+        # start from the most selective filter
+        for col, (lo, hi) in sorted(ranges, key=lambda r: r[1][1] - r[1][0]):
+            col_mask = np.zeros(self.n, dtype=bool)
+            col_mask[self.order[col][lo:hi]] = True
+            mask = col_mask if mask is None else mask & col_mask
+            if not mask.any():
+                break
+
+        return np.flatnonzero(mask)
+
+    def filter(self, **bounds):
+        """
+        Return the rows of cat_df matching the bounds as a new data frame
+        """
+        return self.cat_df.iloc[self.query(**bounds)].reset_index(drop=True)
+
+
+def file_content_hash(filename, chunk_size=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class CatalogueCache(object):
+    """
+    Sidecar cache of parsed catalogue columns stored as compressed npz files
+
+    Entries are keyed by the content hash of the QuakeML file. The size and
+    mtime of every cached source file are recorded in an index so the hash
+    only has to be recomputed when either of them changes. The total size of
+    the cache is kept below max_bytes by evicting the least recently used
+    entries.
+    """
+
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, cache_dir=CAT_CACHE_DIR, max_bytes=CAT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        try:
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.index = {}
+
+    def _save_index(self):
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f)
+
+    def _entry_path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash + '.npz')
+
+    def key(self, filename):
+        """
+        Return the content hash for filename, reusing the recorded hash if the
+        file size and mtime are unchanged
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = self.index.get(filename)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['hash']
+
+        content_hash = file_content_hash(filename)
+        self.index[filename] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': content_hash}
+        self._save_index()
+        return content_hash
+
+    def load(self, filename):
+        """
+        Return the cached cat_df for filename or None if it is not cached
+        """
+        entry_path = self._entry_path(self.key(filename))
+        if not os.path.exists(entry_path):
+            return None
+
+        try:
+            with np.load(entry_path, allow_pickle=False) as cols:
+                cat_df = pd.DataFrame({'event_id': cols['event_id'].astype(object),
+                                       'qtime': cols['qtime'], 'lat': cols['lat'], 'lon': cols['lon'],
+                                       'depth': cols['depth'], 'mag': cols['mag']},
+                                      columns=CAT_COLUMNS)
+        except (IOError, OSError, ValueError, KeyError):
+            # corrupt entry, drop it
+            os.remove(entry_path)
+            return None
+
+        # mark as recently used
+        os.utime(entry_path, None)
+        return cat_df
+
+    def store(self, filename, cat_df):
+        entry_path = self._entry_path(self.key(filename))
+        tmp_path = entry_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, event_id=cat_df['event_id'].values.astype(np.str_),
+                                qtime=cat_df['qtime'].values.astype(np.int64),
+                                lat=cat_df['lat'].values.astype(np.float64),
+                                lon=cat_df['lon'].values.astype(np.float64),
+                                depth=cat_df['depth'].values.astype(np.float64),
+                                mag=cat_df['mag'].values.astype(np.float64))
+        os.rename(tmp_path, entry_path)
+        self.evict()
+
+    def invalidate(self, filename):
+        """
+        Remove the cached entry for filename
+        """
+        filename = os.path.abspath(filename)
+        entry = self.index.pop(filename, None)
+        if entry is None:
+            return
+        self._save_index()
+        entry_path = self._entry_path(entry['hash'])
+        if os.path.exists(entry_path):
+            os.remove(entry_path)
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, name))
+        self.index = {}
+        self._save_index()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        if total <= self.max_bytes:
+            return
+
+        evicted = set()
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            evicted.add(name[:-len('.npz')])
+            total -= size
+
+        # forget source files whose entries were evicted
+        self.index = dict((k, v) for k, v in self.index.items() if v['hash'] not in evicted)
+        self._save_index()
+
+
+def read_catalogue_cached(filename, cache=None):
+    """
+    Read a QuakeML file into cat_df through the parsed catalogue cache
+    """
+    if cache is None:
+        cache = CatalogueCache()
+
+    start = time.time()
+    cat_df = cache.load(filename)
+    if cat_df is not None:
+        print("Loaded cached catalogue in %.3f s" % (time.time() - start))
+        return cat_df
+
+    cat_df = read_catalogue(filename)
+    cache.store(filename, cat_df)
+    return cat_df
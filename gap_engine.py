@@ -0,0 +1,493 @@
+"""
+Vectorised gap and overlap detection over the waveform database.
+
+The start and end times of all entries are loaded as numpy arrays and sorted
+once by (station, component, starttime). Within a channel the difference
+between each starttime and the previous endtime is a gap when it is larger
+than the tolerance and an overlap when it is smaller than -tolerance.
+
+For SQLite databases the same comparison can run inside SQLite with the LAG
+window function (SQLite >= 3.25), so only the gap and overlap rows are
+returned to Python.
+
+The results are persisted next to the database (DATABASE.gaps.npz) together
+with a per-(station, component) watermark: the last processed starttime and
+its endtime. A rerun only examines the entries past the watermark, the
+first of them is compared with the watermark endtime. A channel is
+recomputed from the start when its number of entries or the sum of their
+starttimes up to the watermark changed (entries removed, inserted or
+re-indexed behind it), or its watermark entry changed. The starttime sum is
+read from the station/component/starttime index like the count. In SQLite
+a re-indexed entry (INSERT OR REPLACE) also gets a rowid past the largest
+one of the previous run, which catches entries whose endtime alone changed.
+For .json/.wfidx databases the columns are in memory and the checksum
+covers the endtimes as well.
+
+A run without persisted results is split by station across a process pool,
+each worker opens its own read only SQLite connection or memory mapped
+.wfidx index and the per-channel results are merged by key.
+
+Usage:
+    python gap_engine.py DATABASE.db|DATABASE.json|INDEX.wfidx [--tolerance SECONDS] [--no-window] [--full]
+        [--processes N]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+import numpy as np
+
+from gap_results import GapResults, gap_results_filename
+
+# seconds a starttime may differ from the previous endtime before it counts as a gap/overlap
+GAP_TOLERANCE = 1
+
+# worker processes of a full gap analysis (1 runs it in the calling process)
+GAP_PROCESSES = int(os.environ.get('QC_EVENTS_GAP_PROCESSES', multiprocessing.cpu_count()))
+
+# stations per task handed to a worker
+GAP_STATIONS_PER_TASK = 4
+
+# window functions (LAG ... OVER) were added in SQLite 3.25.0
+SQLITE_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+# previous endtime of the channel for every entry, only the gap/overlap rows are returned
+_WINDOW_GAPS_TEMPLATE = """
+SELECT station, component, starttime, prev_endtime FROM (
+    SELECT station, component, starttime, rowid AS row_id,
+           LAG(endtime) OVER (PARTITION BY station, component ORDER BY starttime, rowid) AS prev_endtime
+    FROM waveforms{where})
+WHERE starttime - prev_endtime > :tolerance OR starttime - prev_endtime < -:tolerance
+ORDER BY station, component, starttime, row_id
+"""
+WINDOW_GAPS_SQL = _WINDOW_GAPS_TEMPLATE.format(where='')
+
+# the same for a single station, a range search of the station/component/starttime index
+STATION_GAPS_SQL = _WINDOW_GAPS_TEMPLATE.format(where=' WHERE station = :station')
+
+# the same over the entries past the watermarks of every channel (a watermark with a NULL endtime
+# takes the whole channel), the watermark rows are prepended to their channels. The CROSS JOIN
+# makes SQLite loop over the watermarks and range search the station/component/starttime index
+INCREMENTAL_GAPS_SQL = """
+SELECT station, component, starttime, prev_endtime FROM (
+    SELECT station, component, starttime, row_id,
+           LAG(endtime) OVER (PARTITION BY station, component ORDER BY starttime, row_id) AS prev_endtime
+    FROM (SELECT waveforms.station, waveforms.component, waveforms.starttime, waveforms.endtime,
+                 waveforms.rowid AS row_id
+          FROM watermarks CROSS JOIN waveforms
+          WHERE waveforms.station = watermarks.station AND waveforms.component = watermarks.component
+            AND waveforms.starttime > watermarks.starttime
+          UNION ALL
+          SELECT station, component, starttime, endtime, -1 FROM watermarks))
+WHERE starttime - prev_endtime > :tolerance OR starttime - prev_endtime < -:tolerance
+ORDER BY station, component, starttime, row_id
+"""
+
+# the per-channel watermarks read by INCREMENTAL_GAPS_SQL
+CREATE_WATERMARKS_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS watermarks (station TEXT, component TEXT, starttime INTEGER, endtime INTEGER,
+                                            PRIMARY KEY (station, component))
+"""
+
+# starttime of the watermark of a channel without persisted results
+NO_WATERMARK = -2 ** 62
+
+
+def sqlite_time_columns(db_filename):
+    """
+    Return the (station, component, starttime, endtime) arrays of the
+    Waveforms table of a SQLite database
+    """
+    conn = sqlite3.connect(db_filename)
+    try:
+        rows = conn.execute("SELECT station, component, starttime, endtime FROM waveforms").fetchall()
+    finally:
+        conn.close()
+    if len(rows) == 0:
+        return (np.array([], dtype=np.str_), np.array([], dtype=np.str_),
+                np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    station, component, starttime, endtime = zip(*rows)
+    return (np.asarray(station, dtype=np.str_), np.asarray(component, dtype=np.str_),
+            np.asarray(starttime, dtype=np.int64), np.asarray(endtime, dtype=np.int64))
+
+
+def _collect_gap_rows(rows, keys):
+    """
+    Gather the (station, component, starttime, prev_endtime) rows of a gap
+    query into {(station, component): (gaps, overlaps)} arrays for the keys
+    """
+    channels = dict((key, ([], [])) for key in keys)
+    for station, component, starttime, prev_endtime in rows:
+        gaps, overlaps = channels[(station, component)]
+        if starttime > prev_endtime:
+            gaps.append((prev_endtime, starttime))
+        else:
+            overlaps.append((starttime, prev_endtime))
+    return dict((key, (np.array(gaps, dtype=np.int64).reshape(-1, 2),
+                       np.array(overlaps, dtype=np.int64).reshape(-1, 2)))
+                for key, (gaps, overlaps) in channels.items())
+
+
+def _last_entry(conn, station, component):
+    # the last entry of a channel, its watermark
+    return tuple(conn.execute("SELECT starttime, endtime FROM waveforms WHERE station = ? AND component = ? "
+                              "ORDER BY starttime DESC, rowid DESC LIMIT 1", (station, component)).fetchone())
+
+
+def _channel_gaps(station_codes, component_codes, starttime, endtime, tolerance):
+    """
+    Gaps and overlaps of arrays already sorted by (station code, component
+    code, starttime). Returns {(station code, component code): (gaps, overlaps)}
+    with (n, 2) int64 arrays of [start, end] rows
+    """
+    n = len(starttime)
+    if n == 0:
+        return {}
+
+    new_channel = (station_codes[1:] != station_codes[:-1]) | (component_codes[1:] != component_codes[:-1])
+    # starttime of each entry against the endtime of the previous entry of the channel
+    diff = starttime[1:] - endtime[:-1]
+    gap_mask = ~new_channel & (diff > tolerance)
+    ovlp_mask = ~new_channel & (diff < -tolerance)
+
+    gaps = np.column_stack((endtime[:-1][gap_mask], starttime[1:][gap_mask]))
+    overlaps = np.column_stack((starttime[1:][ovlp_mask], endtime[:-1][ovlp_mask]))
+
+    channel_starts = np.concatenate(([0], np.flatnonzero(new_channel) + 1))
+    # a gap between rows i and i + 1 belongs to the channel of row i + 1
+    gap_split = np.searchsorted(np.flatnonzero(gap_mask) + 1, channel_starts[1:], side='left')
+    ovlp_split = np.searchsorted(np.flatnonzero(ovlp_mask) + 1, channel_starts[1:], side='left')
+
+    results = {}
+    for lo, chan_gaps, chan_overlaps in zip(channel_starts.tolist(), np.split(gaps, gap_split),
+                                            np.split(overlaps, ovlp_split)):
+        results[(station_codes[lo], component_codes[lo])] = (chan_gaps, chan_overlaps)
+    return results
+
+
+def find_gaps_overlaps(station, component, starttime, endtime, tolerance=GAP_TOLERANCE):
+    """
+    Find the gaps and overlaps of every channel in unsorted entry arrays.
+    Returns {(station, component): (gaps, overlaps)} where gaps holds
+    [previous endtime, starttime] rows and overlaps [starttime, previous endtime] rows
+    """
+    station_names, station_codes = np.unique(np.asarray(station, dtype=np.str_), return_inverse=True)
+    component_names, component_codes = np.unique(np.asarray(component, dtype=np.str_), return_inverse=True)
+    starttime = np.asarray(starttime, dtype=np.int64)
+    endtime = np.asarray(endtime, dtype=np.int64)
+
+    station_codes = station_codes.ravel()
+    component_codes = component_codes.ravel()
+    order = np.lexsort((starttime, component_codes, station_codes))
+    results = _channel_gaps(station_codes[order], component_codes[order], starttime[order], endtime[order],
+                            tolerance)
+    return dict(((str(station_names[sta]), str(component_names[comp])), value)
+                for (sta, comp), value in results.items())
+
+
+def _empty_pairs():
+    return np.empty((0, 2), dtype=np.int64)
+
+
+def load_gap_state(filename, tolerance=GAP_TOLERANCE):
+    """
+    Read persisted gap results, returns {(station, component): channel state}
+    with the watermark (starttime, endtime), the count and time sum (checksum)
+    of the entries up to it, the largest SQLite rowid seen and the
+    gaps/overlaps arrays. Empty if missing or computed with another tolerance
+    """
+    try:
+        results = GapResults.load(filename)
+    except (IOError, OSError, KeyError, ValueError):
+        return {}
+    if results.tolerance != tolerance:
+        return {}
+    return results.channels
+
+
+def _max_rowid(conn):
+    return conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM waveforms").fetchone()[0]
+
+
+def _sqlite_update_state(db_filename, state, tolerance, window_functions):
+    conn = sqlite3.connect(db_filename)
+    try:
+        # read first, entries written during the run are examined again by the next one
+        max_rowid = _max_rowid(conn)
+        # earliest starttime of each channel's entries inserted or re-indexed since the previous run
+        since_rowid = min(chan.get('rowid', 0) for chan in state.values()) if state else max_rowid
+        inserted = dict(((station, component), starttime) for station, component, starttime in conn.execute(
+            "SELECT station, component, MIN(starttime) FROM waveforms WHERE rowid > ? "
+            "GROUP BY station, component", (since_rowid,)))
+
+        totals = dict(((station, component), (count, checksum)) for station, component, count, checksum in
+                      conn.execute("SELECT station, component, COUNT(*), SUM(starttime) FROM waveforms "
+                                   "GROUP BY station, component"))
+
+        # keep the watermarks whose channel is unchanged up to them
+        valid = {}
+        for key, chan in state.items():
+            if key not in totals or 'rowid' not in chan:
+                continue
+            if key in inserted and inserted[key] <= chan['watermark'][0]:
+                # an entry behind the watermark was inserted or re-indexed
+                continue
+            # counted from the few entries past the watermark
+            count_after, checksum_after = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(starttime), 0) FROM waveforms WHERE station = ? AND component = ? "
+                "AND starttime > ?", (key[0], key[1], chan['watermark'][0])).fetchone()
+            watermark_entry = conn.execute(
+                "SELECT COUNT(*) FROM waveforms WHERE station = ? AND component = ? AND starttime = ? "
+                "AND endtime = ?", (key[0], key[1], chan['watermark'][0], chan['watermark'][1])).fetchone()[0]
+            if (totals[key][0] - count_after, totals[key][1] - checksum_after) == \
+                    (chan['count'], chan.get('checksum')) and watermark_entry:
+                valid[key] = chan
+
+        new_gaps = None
+        if window_functions:
+            conn.execute(CREATE_WATERMARKS_SQL)
+            conn.executemany("INSERT INTO watermarks VALUES (?, ?, ?, ?)",
+                             [(key[0], key[1], valid[key]['watermark'][0], valid[key]['watermark'][1])
+                              if key in valid else (key[0], key[1], NO_WATERMARK, None)
+                              for key in totals])
+            try:
+                # without any watermark the plain window query over the index is faster
+                gaps_sql = INCREMENTAL_GAPS_SQL if valid else WINDOW_GAPS_SQL
+                new_gaps = _collect_gap_rows(conn.execute(gaps_sql, {'tolerance': tolerance}), totals)
+            except sqlite3.OperationalError:
+                # an SQLite build without window functions
+                new_gaps = None
+
+        if new_gaps is None:
+            valid = {}
+            new_gaps = find_gaps_overlaps(*sqlite_time_columns(db_filename), tolerance=tolerance)
+
+        new_state = {}
+        for key, (total, checksum) in totals.items():
+            old = valid.get(key, {'gaps': _empty_pairs(), 'overlaps': _empty_pairs()})
+            gaps, overlaps = new_gaps.get(key, (_empty_pairs(), _empty_pairs()))
+            new_state[key] = {'watermark': _last_entry(conn, *key), 'count': total, 'checksum': checksum,
+                              'rowid': max_rowid,
+                              'gaps': np.concatenate((old['gaps'], gaps)),
+                              'overlaps': np.concatenate((old['overlaps'], overlaps))}
+    finally:
+        conn.close()
+    return new_state
+
+
+def _index_update_state(index, state, tolerance, stations=None):
+    new_state = {}
+    for key, (lo, hi, _) in index.groups.items():
+        if stations is not None and key[0] not in stations:
+            continue
+        st = index.starttime[lo:hi]
+        et = index.endtime[lo:hi]
+        chan = state.get(key)
+
+        first = 0
+        prev_end = et[:-1]
+        if chan is not None:
+            count = int(np.searchsorted(st, chan['watermark'][0], side='right'))
+            watermark_entry = np.any((st[:count] == chan['watermark'][0]) & (et[:count] == chan['watermark'][1]))
+            if (count, int(st[:count].sum() + et[:count].sum())) == (chan['count'], chan.get('checksum')) and \
+                    watermark_entry:
+                # stitch the entries past the watermark to the watermark endtime
+                first = count
+                prev_end = np.concatenate(([chan['watermark'][1]], et[count:]))[:-1]
+            else:
+                chan = None
+        if first == 0:
+            st = st[1:]
+        else:
+            st = st[first:]
+
+        diff = st - prev_end
+        gap_mask = diff > tolerance
+        ovlp_mask = diff < -tolerance
+        gaps = np.column_stack((prev_end[gap_mask], st[gap_mask]))
+        overlaps = np.column_stack((st[ovlp_mask], prev_end[ovlp_mask]))
+        if chan is not None:
+            gaps = np.concatenate((chan['gaps'], gaps))
+            overlaps = np.concatenate((chan['overlaps'], overlaps))
+
+        new_state[key] = {'watermark': (int(index.starttime[hi - 1]), int(index.endtime[hi - 1])),
+                          'count': hi - lo,
+                          'checksum': int(index.starttime[lo:hi].sum() + index.endtime[lo:hi].sum()),
+                          'gaps': gaps.astype(np.int64).reshape(-1, 2),
+                          'overlaps': overlaps.astype(np.int64).reshape(-1, 2)}
+    return new_state
+
+
+def _sqlite_stations_state(conn, stations, tolerance, window_functions):
+    """
+    Full gap state of the channels of some stations
+    """
+    state = {}
+    for station in stations:
+        max_rowid = _max_rowid(conn)
+        totals = dict(((station, component), (count, checksum)) for component, count, checksum in conn.execute(
+            "SELECT component, COUNT(*), SUM(starttime) FROM waveforms WHERE station = ? GROUP BY component",
+            (station,)))
+        gaps = None
+        if window_functions:
+            try:
+                gaps = _collect_gap_rows(conn.execute(STATION_GAPS_SQL, {'tolerance': tolerance,
+                                                                         'station': station}), totals)
+            except sqlite3.OperationalError:
+                window_functions = False
+        if gaps is None:
+            rows = conn.execute("SELECT station, component, starttime, endtime FROM waveforms "
+                                "WHERE station = ?", (station,)).fetchall()
+            gaps = find_gaps_overlaps(*[np.asarray(column) for column in zip(*rows)], tolerance=tolerance)
+
+        for key, (total, checksum) in totals.items():
+            state[key] = {'watermark': _last_entry(conn, *key), 'count': total, 'checksum': checksum,
+                          'rowid': max_rowid,
+                          'gaps': gaps[key][0], 'overlaps': gaps[key][1]}
+    return state
+
+
+# read only connection or memory mapped index of a worker process
+_worker_db = None
+
+
+def _connect_read_only(db_filename):
+    try:
+        return sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(db_filename)), uri=True)
+    except TypeError:
+        # Python 2 has no uri connections
+        conn = sqlite3.connect(db_filename)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+def _init_gap_worker(db_filename, index_filename):
+    global _worker_db
+    if index_filename is None:
+        _worker_db = _connect_read_only(db_filename)
+    else:
+        from waveform_index import WaveformIndex
+        _worker_db = WaveformIndex.open(index_filename)
+
+
+def _stations_state_task(args):
+    stations, tolerance, window_functions = args
+    if isinstance(_worker_db, sqlite3.Connection):
+        return _sqlite_stations_state(_worker_db, stations, tolerance, window_functions)
+    return _index_update_state(_worker_db, {}, tolerance, stations=set(stations))
+
+
+def parallel_gap_state(db_filename, tolerance=GAP_TOLERANCE, index=None, processes=GAP_PROCESSES,
+                       window_functions=None):
+    """
+    Full gap state of a database computed by station across a process pool.
+    Workers open the .db read only or memory map the .wfidx index (a .json
+    database is written to a temporary .wfidx first). The merged result
+    does not depend on the number of workers
+    """
+    if window_functions is None:
+        window_functions = SQLITE_WINDOW_FUNCTIONS
+
+    temp_dir = None
+    index_filename = None
+    if db_filename.endswith('.db'):
+        conn = sqlite3.connect(db_filename)
+        try:
+            stations = [row[0] for row in conn.execute("SELECT DISTINCT station FROM waveforms ORDER BY station")]
+        finally:
+            conn.close()
+    else:
+        if db_filename.endswith('.wfidx'):
+            index_filename = db_filename
+        else:
+            if index is None:
+                from waveform_index import open_waveform_index
+                index = open_waveform_index(db_filename)
+            temp_dir = tempfile.mkdtemp(prefix='qc_events_gaps')
+            index_filename = os.path.join(temp_dir, 'index.wfidx')
+            index.save(index_filename)
+        if index is None:
+            from waveform_index import WaveformIndex
+            index = WaveformIndex.open(index_filename)
+        stations = sorted(index.station_components)
+
+    tasks = [(stations[i:i + GAP_STATIONS_PER_TASK], tolerance, window_functions)
+             for i in range(0, len(stations), GAP_STATIONS_PER_TASK)]
+
+    state = {}
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_gap_worker,
+                                initargs=(db_filename, index_filename))
+    try:
+        for task_state in pool.imap(_stations_state_task, tasks):
+            state.update(task_state)
+    finally:
+        pool.close()
+        pool.join()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    return state
+
+
+def update_gaps_overlaps(db_filename, tolerance=GAP_TOLERANCE, index=None, state_filename=None, full=False,
+                         window_functions=None, processes=GAP_PROCESSES, save=True):
+    """
+    Gaps and overlaps of a .db, .json or .wfidx waveform database (see
+    find_gaps_overlaps) that only examines the entries past the watermarks
+    persisted in state_filename (DATABASE.gaps.npz by default) and saves the
+    updated results there, unless save is False for callers that add to the
+    results before saving them once. index is the already opened
+    WaveformIndex of a .json/.wfidx database, full ignores the persisted
+    results. Without persisted results the analysis runs on processes workers.
+    Returns the GapResults, their recording intervals are left empty
+    """
+    if state_filename is None:
+        state_filename = gap_results_filename(db_filename)
+    if window_functions is None:
+        window_functions = SQLITE_WINDOW_FUNCTIONS
+
+    state = {} if full else load_gap_state(state_filename, tolerance)
+
+    if not state and processes != 1:
+        state = parallel_gap_state(db_filename, tolerance=tolerance, index=index, processes=processes,
+                                   window_functions=window_functions)
+    elif db_filename.endswith('.db'):
+        state = _sqlite_update_state(db_filename, state, tolerance, window_functions)
+    else:
+        if index is None:
+            from waveform_index import open_waveform_index
+            index = open_waveform_index(db_filename)
+        state = _index_update_state(index, state, tolerance)
+
+    results = GapResults(state, tolerance=tolerance)
+    if save:
+        results.save(state_filename)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the recording gaps and overlaps of a waveform database")
+    parser.add_argument('db_filename')
+    parser.add_argument('--tolerance', type=float, default=GAP_TOLERANCE, help="seconds (default: 1)")
+    parser.add_argument('--no-window', action='store_true', help="do not use SQLite window functions")
+    parser.add_argument('--full', action='store_true', help="ignore the persisted results and watermarks")
+    parser.add_argument('--processes', type=int, default=GAP_PROCESSES, help="workers of a full analysis")
+
+    args = parser.parse_args()
+
+    start = time.time()
+    results = update_gaps_overlaps(args.db_filename, tolerance=args.tolerance, full=args.full,
+                                   window_functions=False if args.no_window else None, processes=args.processes)
+    for station, component in results.keys():
+        gaps = results.gaps(station, component)
+        overlaps = results.overlaps(station, component)
+        print("%s.%s: %s gaps, %s overlaps" % (station, component, len(gaps), len(overlaps)))
+    print("Done in %.2f s" % (time.time() - start))
@@ -0,0 +1,239 @@
+"""
+Array backed container of the gap, overlap and recording interval results.
+
+Each (station, channel) holds (n, 2) int64 arrays of [start, end] rows, plus
+the watermark, entry count, time checksum and rowid used by incremental gap
+analysis. The results are saved as one .npz file next to the database where
+every kind of interval is concatenated over the channels with an offsets
+array, so the file stays a few MB for years of data and loads without any
+per-interval objects.
+
+CoverageMatrix is the (station x day) completeness overview derived from
+the recording intervals, cached next to the database as well.
+"""
+
+import numpy as np
+
+from intervals import SECONDS_PER_DAY, daily_coverage_matrix
+from waveform_index import replace_file
+
+KINDS = ('gaps', 'overlaps', 'intervals')
+
+GAP_RESULTS_SUFFIX = '.gaps.npz'
+
+COVERAGE_SUFFIX = '.coverage.npz'
+
+
+def empty_intervals():
+    return np.empty((0, 2), dtype=np.int64)
+
+
+class GapResults(object):
+
+    def __init__(self, channels=None, tolerance=None):
+        """
+        channels maps (station, channel) to a dict with the KINDS arrays,
+        the watermark (starttime, endtime), count and time sum (checksum) of
+        the entries up to it and the largest SQLite rowid seen
+        """
+        self.channels = channels if channels is not None else {}
+        self.tolerance = tolerance
+
+    def __contains__(self, key):
+        return key in self.channels
+
+    def __len__(self):
+        return len(self.channels)
+
+    def keys(self):
+        return sorted(self.channels)
+
+    def stations(self):
+        return sorted(set(station for station, _ in self.channels))
+
+    def _get(self, kind, station, channel):
+        chan = self.channels.get((station, channel))
+        if chan is None or kind not in chan:
+            return empty_intervals()
+        return chan[kind]
+
+    def gaps(self, station, channel):
+        return self._get('gaps', station, channel)
+
+    def overlaps(self, station, channel):
+        return self._get('overlaps', station, channel)
+
+    def intervals(self, station, channel):
+        return self._get('intervals', station, channel)
+
+    def set_intervals(self, station, channel, intervals):
+        self.channels[(station, channel)]['intervals'] = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+
+    def nbytes(self):
+        return sum(chan[kind].nbytes for chan in self.channels.values() for kind in KINDS if kind in chan)
+
+    def save(self, filename):
+        """
+        Write the results as a .npz file (replaced atomically)
+        """
+        keys = self.keys()
+        arrays = {'stations': np.array([station for station, _ in keys], dtype=np.str_),
+                  'channels': np.array([channel for _, channel in keys], dtype=np.str_),
+                  'watermarks': np.array([self.channels[key].get('watermark', (0, 0)) for key in keys],
+                                         dtype=np.int64).reshape(-1, 2),
+                  'counts': np.array([self.channels[key].get('count', 0) for key in keys], dtype=np.int64),
+                  'checksums': np.array([self.channels[key].get('checksum', 0) for key in keys], dtype=np.int64),
+                  'rowids': np.array([self.channels[key].get('rowid', 0) for key in keys], dtype=np.int64),
+                  'tolerance': np.array(np.nan if self.tolerance is None else self.tolerance, dtype=np.float64)}
+        for kind in KINDS:
+            parts = [self._get(kind, *key) for key in keys]
+            arrays[kind + '_offsets'] = np.concatenate(([0], np.cumsum([len(part) for part in parts]))).astype(
+                np.int64)
+            arrays[kind] = np.concatenate(parts) if parts else empty_intervals()
+
+        # np.savez appends .npz to names without it
+        temp_filename = filename + '.tmp.npz'
+        np.savez_compressed(temp_filename, **arrays)
+        replace_file(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a .npz written by save, the per-channel arrays are views into
+        the concatenated arrays
+        """
+        with np.load(filename) as data:
+            arrays = dict((name, data[name]) for name in data.files)
+
+        tolerance = float(arrays['tolerance'])
+        channels = {}
+        for i, key in enumerate(zip(arrays['stations'].tolist(), arrays['channels'].tolist())):
+            chan = {'watermark': tuple(arrays['watermarks'][i].tolist()), 'count': int(arrays['counts'][i])}
+            if 'checksums' in arrays:
+                # results saved without checksums are recomputed by the next incremental run
+                chan['checksum'] = int(arrays['checksums'][i])
+                chan['rowid'] = int(arrays['rowids'][i])
+            for kind in KINDS:
+                offsets = arrays[kind + '_offsets']
+                chan[kind] = arrays[kind][offsets[i]:offsets[i + 1]]
+            channels[key] = chan
+        return cls(channels, tolerance=None if np.isnan(tolerance) else tolerance)
+
+
+def gap_results_filename(db_filename):
+    return db_filename + GAP_RESULTS_SUFFIX
+
+
+def coverage_filename(db_filename):
+    return db_filename + COVERAGE_SUFFIX
+
+
+def changed_stations(old_results, new_results):
+    """
+    Stations with a channel added, removed, moved past its watermark or
+    with other recording intervals (e.g. after the station dates of the
+    inventory changed) between two GapResults
+    """
+    if old_results is None:
+        return set(new_results.stations())
+    changed = set()
+    for key in set(old_results.channels) | set(new_results.channels):
+        old = old_results.channels.get(key)
+        new = new_results.channels.get(key)
+        if old is None or new is None or tuple(old['watermark']) != tuple(new['watermark']) or \
+                old['count'] != new['count'] or old.get('checksum') != new.get('checksum') or \
+                not np.array_equal(old_results.intervals(*key), new_results.intervals(*key)):
+            changed.add(key[0])
+    return changed
+
+
+class CoverageMatrix(object):
+    """
+    float32 (station x day) matrix of the fraction of each UTC day recorded,
+    averaged over the channels of the station
+    """
+
+    def __init__(self, stations, first_day, matrix):
+        self.stations = list(stations)
+        self.first_day = int(first_day) // SECONDS_PER_DAY * SECONDS_PER_DAY
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+
+    @property
+    def n_days(self):
+        return self.matrix.shape[1]
+
+    @staticmethod
+    def day_range(gap_results):
+        """
+        (first day, number of days) spanned by the recording intervals
+        """
+        starts = [chan['intervals'][0, 0] for chan in gap_results.channels.values()
+                  if len(chan.get('intervals', ())) > 0]
+        ends = [chan['intervals'][-1, 1] for chan in gap_results.channels.values()
+                if len(chan.get('intervals', ())) > 0]
+        if not starts:
+            return 0, 0
+        first_day = int(min(starts)) // SECONDS_PER_DAY * SECONDS_PER_DAY
+        return first_day, -(-(int(max(ends)) - first_day) // SECONDS_PER_DAY)
+
+    @staticmethod
+    def _rows(gap_results, stations, first_day, n_days):
+        # daily coverage of every channel of the stations in one pass, then averaged per station
+        keys = [key for key in gap_results.keys() if key[0] in set(stations)]
+        chan_matrix = daily_coverage_matrix([gap_results.intervals(*key) for key in keys], first_day, n_days)
+
+        station_index = dict((station, i) for i, station in enumerate(stations))
+        rows = np.array([station_index[station] for station, _ in keys], dtype=np.int64)
+        matrix = np.zeros((len(stations), n_days))
+        np.add.at(matrix, rows, chan_matrix)
+        n_channels = np.bincount(rows, minlength=len(stations))
+        return (matrix / np.maximum(n_channels, 1)[:, np.newaxis]).astype(np.float32)
+
+    @classmethod
+    def compute(cls, gap_results, stations=None):
+        if stations is None:
+            stations = gap_results.stations()
+        first_day, n_days = cls.day_range(gap_results)
+        return cls(stations, first_day, cls._rows(gap_results, stations, first_day, n_days))
+
+    def update(self, gap_results, stations):
+        """
+        Recompute the rows of the given stations (e.g. from changed_stations)
+        and the days the results now extend to; new stations are appended
+        """
+        first_day, n_days = self.day_range(gap_results)
+        if n_days == 0 or first_day < self.first_day:
+            # the matrix can only grow at the end, anything else is rebuilt
+            rebuilt = self.compute(gap_results, sorted(set(self.stations) | set(gap_results.stations())))
+            self.stations, self.first_day, self.matrix = rebuilt.stations, rebuilt.first_day, rebuilt.matrix
+            return
+
+        new_stations = [station for station in gap_results.stations() if station not in self.stations]
+        self.stations.extend(new_stations)
+
+        total_days = (first_day - self.first_day) // SECONDS_PER_DAY + n_days
+        old_days = min(self.n_days, total_days)
+        matrix = np.zeros((len(self.stations), total_days), dtype=np.float32)
+        matrix[:self.matrix.shape[0], :old_days] = self.matrix[:, :old_days]
+
+        if total_days > old_days:
+            # the new days of every station
+            matrix[:, old_days:] = self._rows(gap_results, self.stations,
+                                              self.first_day + old_days * SECONDS_PER_DAY, total_days - old_days)
+
+        update_stations = [station for station in self.stations if station in set(stations) | set(new_stations)]
+        if update_stations:
+            rows = [self.stations.index(station) for station in update_stations]
+            matrix[rows] = self._rows(gap_results, update_stations, self.first_day, total_days)
+        self.matrix = matrix
+
+    def save(self, filename):
+        temp_filename = filename + '.tmp.npz'
+        np.savez_compressed(temp_filename, stations=np.array(self.stations, dtype=np.str_),
+                            first_day=np.array(self.first_day, dtype=np.int64), matrix=self.matrix)
+        replace_file(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['stations'].tolist(), int(data['first_day']), data['matrix'])
@@ -0,0 +1,193 @@
+"""
+Vectorised set algebra on time intervals.
+
+An interval set is an (n, 2) int64 array of [start, end) rows. The
+functions accept any rows and return normalised sets: sorted by start with
+overlapping or touching intervals merged, so set operations reduce to
+sorting and cumulative sums over the interval boundaries.
+"""
+import numpy as np
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def as_intervals(intervals):
+    return np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+
+
+def normalize(intervals):
+    """
+    Sort the intervals and merge the overlapping or touching ones, empty
+    intervals are dropped
+    """
+    intervals = as_intervals(intervals)
+    intervals = intervals[intervals[:, 1] > intervals[:, 0]]
+    if len(intervals) == 0:
+        return intervals
+
+    intervals = intervals[np.argsort(intervals[:, 0], kind='mergesort')]
+    # furthest end seen before each interval, a new run starts beyond it
+    prev_max_end = np.maximum.accumulate(intervals[:, 1])[:-1]
+    run_starts = np.concatenate(([0], np.flatnonzero(intervals[1:, 0] > prev_max_end) + 1))
+    return np.column_stack((intervals[run_starts, 0], np.maximum.reduceat(intervals[:, 1], run_starts)))
+
+
+def _cover(interval_sets, min_count):
+    """
+    Intervals covered by at least min_count of the normalised interval sets
+    """
+    starts = np.concatenate([intervals[:, 0] for intervals in interval_sets])
+    ends = np.concatenate([intervals[:, 1] for intervals in interval_sets])
+    if len(starts) == 0:
+        return as_intervals([])
+
+    times = np.concatenate((starts, ends))
+    steps = np.concatenate((np.ones(len(starts), dtype=np.int64), -np.ones(len(ends), dtype=np.int64)))
+    # ends sort before starts at the same time, so touching intervals do not count as overlapping
+    order = np.lexsort((steps, times))
+    times = times[order]
+    count = np.cumsum(steps[order])
+
+    covered = count >= min_count
+    entering = np.flatnonzero(covered & np.concatenate(([True], ~covered[:-1])))
+    leaving = np.flatnonzero(~covered & np.concatenate(([False], covered[:-1])))
+    return normalize(np.column_stack((times[entering], times[leaving])))
+
+
+def union(*interval_sets):
+    if len(interval_sets) == 0:
+        return as_intervals([])
+    return normalize(np.concatenate([as_intervals(intervals) for intervals in interval_sets]))
+
+
+def intersection(*interval_sets):
+    """
+    Intervals covered by every set, e.g. the times all components recorded
+    """
+    if len(interval_sets) == 0:
+        return as_intervals([])
+    return _cover([normalize(intervals) for intervals in interval_sets], len(interval_sets))
+
+
+def clip(intervals, start, end):
+    intervals = normalize(intervals)
+    return normalize(np.column_stack((np.maximum(intervals[:, 0], start), np.minimum(intervals[:, 1], end))))
+
+
+def complement(intervals, start, end):
+    """
+    The parts of [start, end) not covered by the intervals
+    """
+    intervals = clip(intervals, start, end)
+    bounds = np.concatenate(([start], intervals.ravel(), [end]))
+    return normalize(bounds.reshape(-1, 2))
+
+
+def difference(intervals, other):
+    intervals = normalize(intervals)
+    if len(intervals) == 0:
+        return intervals
+    return intersection(intervals, complement(other, intervals[0, 0], intervals[-1, 1]))
+
+
+def total_duration(intervals):
+    intervals = normalize(intervals)
+    return int((intervals[:, 1] - intervals[:, 0]).sum())
+
+
+def covered_seconds(intervals, times):
+    """
+    Seconds covered by the intervals before each of the times
+    """
+    intervals = normalize(intervals)
+    times = np.asarray(times, dtype=np.int64)
+    if len(intervals) == 0:
+        return np.zeros(times.shape, dtype=np.int64)
+
+    durations = intervals[:, 1] - intervals[:, 0]
+    before = np.concatenate(([0], np.cumsum(durations)))
+    # the interval each time falls in or after
+    i = np.searchsorted(intervals[:, 0], times, side='right') - 1
+    inside = np.clip(times - intervals[np.maximum(i, 0), 0], 0, durations[np.maximum(i, 0)])
+    return np.where(i < 0, 0, before[np.maximum(i, 0)] + inside)
+
+
+def coverage(intervals, start, end):
+    """
+    Fraction of [start, end) covered by the intervals
+    """
+    if end <= start:
+        return 0.0
+    return total_duration(clip(intervals, start, end)) / float(end - start)
+
+
+def daily_coverage(intervals, first_day, n_days):
+    """
+    Fraction of each of n_days days (UTC, starting at the day of the
+    first_day timestamp) covered by the intervals
+    """
+    day_start = int(first_day) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    bounds = day_start + np.arange(n_days + 1, dtype=np.int64) * SECONDS_PER_DAY
+    return np.diff(covered_seconds(intervals, bounds)) / float(SECONDS_PER_DAY)
+
+
+def merge_close(intervals, min_gap):
+    """
+    Merge normalised intervals separated by less than min_gap
+    """
+    intervals = as_intervals(intervals)
+    if len(intervals) < 2:
+        return intervals
+    run_starts = np.concatenate(([0], np.flatnonzero(intervals[1:, 0] - intervals[:-1, 1] >= min_gap) + 1))
+    run_ends = np.concatenate((run_starts[1:], [len(intervals)])) - 1
+    return np.column_stack((intervals[run_starts, 0], intervals[run_ends, 1]))
+
+
+class IntervalLOD(object):
+    """
+    Level of detail pyramid of an interval set for plotting: level k merges
+    the gaps shorter than 2 ** k seconds, so the intervals visible at any
+    zoom are bounded by the number of pixels across the view
+    """
+
+    def __init__(self, intervals):
+        self.levels = [normalize(intervals)]
+
+    def level(self, resolution):
+        """
+        The coarsest level whose merged gaps are shorter than resolution
+        """
+        k = max(int(np.floor(np.log2(max(resolution, 1)))), 0)
+        while len(self.levels) <= k:
+            # built lazily, each level from the one below
+            self.levels.append(merge_close(self.levels[-1], 2 ** len(self.levels)))
+        return self.levels[k]
+
+    def visible(self, start, end, resolution):
+        """
+        The intervals overlapping [start, end) with gaps shorter than
+        resolution merged
+        """
+        intervals = self.level(resolution)
+        lo = np.searchsorted(intervals[:, 1], start, side='right')
+        hi = np.searchsorted(intervals[:, 0], end, side='left')
+        return intervals[lo:hi]
+
+
+def daily_coverage_matrix(interval_sets, first_day, n_days):
+    """
+    (len(interval_sets), n_days) fraction of each UTC day covered by each
+    interval set. The sets are shifted onto one timeline, n_days apart, so
+    all rows are computed by a single covered_seconds pass
+    """
+    day_start = int(first_day) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    span = n_days * SECONDS_PER_DAY
+    if len(interval_sets) == 0 or n_days <= 0:
+        return np.zeros((len(interval_sets), max(n_days, 0)))
+
+    shifted = [clip(intervals, day_start, day_start + span) - day_start + row * span
+               for row, intervals in enumerate(interval_sets)]
+    rows = np.arange(len(interval_sets), dtype=np.int64)[:, np.newaxis]
+    bounds = rows * span + np.arange(n_days + 1, dtype=np.int64) * SECONDS_PER_DAY
+    covered = covered_seconds(np.concatenate(shifted), bounds.ravel()).reshape(bounds.shape)
+    return np.diff(covered, axis=1) / float(SECONDS_PER_DAY)
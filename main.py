@@ -1,5 +1,5 @@
 from PyQt4 import QtCore, QtGui, QtWebKit, QtNetwork, uic
-from obspy import read_inventory, read_events, UTCDateTime, Stream, read
+from obspy import read_inventory, UTCDateTime, Stream, read
 from obspy.clients.fdsn.client import Client
 from obspy.clients.fdsn.header import FDSNException
 import functools
@@ -11,19 +11,24 @@ import json
 
 from DateAxisItem import DateAxisItem
 
-import pandas as pd
 import numpy as np
 from query_input_yes_no import query_yes_no
 import sys
 
 from sqlalchemy import create_engine
-from sqlalchemy import and_, or_
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func
 
-from waveforms_db import Waveforms
+from waveform_index import WaveformIndex
+from waveform_indexer import index_archive
+from waveforms_db import migrate_db, event_window_query, station_extents_query
+from gap_engine import GAP_TOLERANCE, GAP_PROCESSES, update_gaps_overlaps
+from gap_results import GapResults, gap_results_filename, CoverageMatrix, coverage_filename, changed_stations
+from intervals import complement, intersection, coverage, union, IntervalLOD
+from tile_cache import TileCache, DEFAULT_TILE_SOURCE, MAP_CACHE_DIR, HTTP_CACHE_MAX_BYTES, prefetch_tiles, \
+    parse_zooms, check_map_assets
+from catalogue import read_catalogue_cached, add_time_columns, CatalogueIndex
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # load in Qt Designer UI files
 qc_events_ui = "qc_events.ui"
@@ -32,6 +37,14 @@ select_stacomp_dialog_ui = "select_stacomp_dialog.ui"
 Ui_MainWindow, QtBaseClass = uic.loadUiType(qc_events_ui)
 Ui_SelectDialog, QtBaseClass = uic.loadUiType(select_stacomp_dialog_ui)
 
+# Database file types served through the in-memory/memory mapped WaveformIndex
+WAVEFORM_INDEX_EXTS = (".json", ".wfidx")
+
+# Maximum number of markers sent to the map per javascript call
+MARKER_CHUNK_SIZE = 10000
+# Catalogues with more events than this are drawn on the canvas event layer
+CANVAS_EVENT_THRESHOLD = 5000
+
 STATION_VIEW_ITEM_TYPES = {
     "NETWORK": 0,
     "STATION": 1,
@@ -130,13 +143,29 @@ class selectionDialog(QtGui.QDialog):
 class PandasModel(QtCore.QAbstractTableModel):
     """
     Class to populate a table view with a pandas dataframe
+
+    Every column is kept as its own typed array. Cells are only formatted when
+    the view asks for them (i.e. for visible rows) and the formatted strings
+    are memoised in a bounded cache per column.
+
+    Sorting never moves the data: the model keeps a permutation from view rows
+    to data rows (self.order) and its inverse (self.inverse) as integer arrays.
     """
 
+    # maximum number of formatted cells remembered per column
+    CELL_CACHE_SIZE = 4096
+
     def __init__(self, data, cat_nm=None, parent=None):
         QtCore.QAbstractTableModel.__init__(self, parent)
-        self._data = np.array(data.values)
         self._cols = data.columns
-        self.r, self.c = np.shape(self._data)
+        self._col_data = [data[col].values for col in data.columns]
+        self.r, self.c = len(data), len(self._cols)
+
+        self._cell_cache = [OrderedDict() for _ in range(self.c)]
+
+        self.order = np.arange(self.r)
+        self.inverse = np.arange(self.r)
+        self._rank_cache = {}
 
         self.cat_nm = cat_nm
 
@@ -150,11 +179,71 @@ class PandasModel(QtCore.QAbstractTableModel):
     def columnCount(self, parent=None):
         return self.c
 
+    def data_row(self, view_row):
+        return int(self.order[view_row])
+
+    def view_row(self, data_row):
+        return int(self.inverse[data_row])
+
+    def _sort_key(self, col, ascending):
+        # integer ranks so that any column dtype can be sorted in either direction
+        if col not in self._rank_cache:
+            self._rank_cache[col] = np.unique(self._col_data[col], return_inverse=True)[1].ravel()
+        ranks = self._rank_cache[col]
+        return ranks if ascending else -ranks
+
+    def _set_order(self, order):
+        self.layoutAboutToBeChanged.emit()
+        self.order = order
+        self.inverse = np.empty_like(order)
+        self.inverse[order] = np.arange(len(order))
+        self.layoutChanged.emit()
+
+    def sort(self, col, order=QtCore.Qt.AscendingOrder):
+        """
+        Stable sort of the current view by one column, so repeated header
+        clicks build up a multi-column sort
+        """
+        if col < 0 or col >= self.c:
+            return
+        key = self._sort_key(col, order == QtCore.Qt.AscendingOrder)
+        self._set_order(self.order[np.argsort(key[self.order], kind='mergesort')])
+
+    def sort_by(self, sort_keys):
+        """
+        Stable multi-column sort, sort_keys is a list of (column, ascending)
+        with the primary key first
+        """
+        keys = [self._sort_key(col, ascending) for col, ascending in reversed(sort_keys)]
+        if len(keys) == 0:
+            self._set_order(np.arange(self.r))
+        else:
+            self._set_order(np.lexsort(keys))
+
+    def format_cell(self, row, col):
+        cache = self._cell_cache[col]
+        if row in cache:
+            # move to the most recently used end
+            text = cache.pop(row)
+            cache[row] = text
+            return text
+
+        value = self._col_data[col][row]
+        if isinstance(value, (float, np.floating)) and np.isnan(value):
+            text = ''
+        else:
+            text = str(value)
+
+        cache[row] = text
+        if len(cache) > self.CELL_CACHE_SIZE:
+            cache.popitem(last=False)
+        return text
+
     def data(self, index, role=QtCore.Qt.DisplayRole):
 
         if index.isValid():
             if role == QtCore.Qt.DisplayRole:
-                return self._data[index.row(), index.column()]
+                return self.format_cell(self.order[index.row()], index.column())
         return None
 
     def headerData(self, p_int, orientation, role):
@@ -187,6 +276,8 @@ class TableDialog(QtGui.QDialog):
         self.cat_event_table_view = QtGui.QTableView()
 
         self.cat_event_table_view.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+        self.cat_event_table_view.horizontalHeader().setClickable(True)
+        self.cat_event_table_view.horizontalHeader().setSortIndicatorShown(True)
 
         self.layout.addWidget(self.cat_event_table_view)
 
@@ -201,19 +292,77 @@ class TableDialog(QtGui.QDialog):
         self.show()
 
 
+class CatFilterDialog(QtGui.QDialog):
+    """
+    Dialog to enter time, magnitude and depth bounds for the event catalogue,
+    empty fields are not applied and every bound is inclusive
+    """
+
+    def __init__(self, parent=None):
+        super(CatFilterDialog, self).__init__(parent)
+        self.setWindowTitle('Filter Catalogue')
+
+        self.labels = OrderedDict([('mintime', 'Start Time (UTC)'), ('maxtime', 'End Time (UTC)'),
+                                   ('minmag', 'Min Mag'), ('maxmag', 'Max Mag'),
+                                   ('mindepth', 'Min Depth (km)'), ('maxdepth', 'Max Depth (km)')])
+        self.fields = OrderedDict()
+        layout = QtGui.QFormLayout(self)
+        layout.addRow(QtGui.QLabel("Bounds are inclusive (min <= value <= max), leave a field empty to skip it"))
+        for key, label in self.labels.iteritems():
+            self.fields[key] = QtGui.QLineEdit()
+            layout.addRow(label, self.fields[key])
+
+        buttons = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok | QtGui.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def accept(self):
+        # keep the dialog open until every field parses
+        try:
+            self.getBounds()
+        except ValueError as e:
+            QtGui.QMessageBox.warning(self, 'Filter Catalogue', str(e))
+            return
+        super(CatFilterDialog, self).accept()
+
+    def getBounds(self):
+        bounds = {}
+        for key, field in self.fields.iteritems():
+            text = str(field.text()).strip()
+            if not text:
+                continue
+            try:
+                if key in ('mintime', 'maxtime'):
+                    bounds[key] = UTCDateTime(text).timestamp
+                else:
+                    bounds[key] = float(text)
+            except (ValueError, TypeError):
+                raise ValueError("Invalid %s: %s" % (self.labels[key], text))
+        return bounds
+
+
 class DataAvailPlot(QtGui.QDialog):
     '''
     Dialog for Data Availablity plot
     '''
 
-    def __init__(self, parent=None, sta_list=None, chan_list=None, rec_int_dict=None):
+    def __init__(self, parent=None, sta_list=None, chan_list=None, gap_results=None):
         super(DataAvailPlot, self).__init__(parent)
         self.setWindowTitle('Data Availability Plot')
 
-        self.rec_int_dict = rec_int_dict
+        self.gap_results = gap_results
         self.sta_list = sta_list
         self.chan_list = chan_list
 
+        # (station id, IntervalLOD) of every plotted station
+        self.lod_rows = []
+
+        # redraw once the view range settles rather than on every range change
+        self.lod_timer = QtCore.QTimer()
+        self.lod_timer.setSingleShot(True)
+        self.lod_timer.timeout.connect(self.update_lod)
+
         self.initUI()
         self.plot_data()
 
@@ -260,32 +409,170 @@ class DataAvailPlot(QtGui.QDialog):
             # When Mouse is moved over plot print the data coordinates
             self.plot.scene().sigMouseMoved.connect(self.dispMousePos)
 
-            rec_midpoints = []
-            sta_ids = []
-            diff_frm_mid_list = []
+            # the selected channels of a station are drawn on one row, so only their union is plotted
+            self.lod_rows = []
+            for stn_key in select_sta:
+                rec_array = union(*[self.gap_results.intervals(stn_key, chan_key) for chan_key in select_comp])
+                self.lod_rows.append((get_sta_id(stn_key), IntervalLOD(rec_array)))
+
+            # Plot Error bar data recording intervals, the visible ones are set by update_lod
+            self.err = pg.ErrorBarItem(x=np.empty(0), y=np.empty(0), left=np.empty(0), right=np.empty(0), beam=0.06)
+            self.plot.addItem(self.err)
+
+            starts = [lod.levels[0][0, 0] for _, lod in self.lod_rows if len(lod.levels[0])]
+            ends = [lod.levels[0][-1, 1] for _, lod in self.lod_rows if len(lod.levels[0])]
+            if starts:
+                self.plot.setXRange(min(starts), max(ends), padding=0.02)
+            self.plot.setYRange(-0.5, len(select_sta) - 0.5)
+
+            self.plot.sigXRangeChanged.connect(lambda *args: self.lod_timer.start(20))
+            self.update_lod()
+
+    def update_lod(self):
+        # plot only the intervals in view, merged to the width of a pixel
+        x_start, x_end = self.plot.vb.viewRange()[0]
+        resolution = self.plot.vb.viewPixelSize()[0]
+
+        rec_starts = [np.empty(0)]
+        rec_ends = [np.empty(0)]
+        sta_ids = [np.empty(0)]
+        for sta_id, lod in self.lod_rows:
+            rec_array = lod.visible(x_start, x_end, resolution)
+            rec_starts.append(rec_array[:, 0])
+            rec_ends.append(rec_array[:, 1])
+            sta_ids.append(np.full(len(rec_array), sta_id))
+
+        rec_starts = np.concatenate(rec_starts)
+        diff_frm_mid = (np.concatenate(rec_ends) - rec_starts) / 2.0
+
+        self.err.setOpts(x=rec_starts + diff_frm_mid, y=np.concatenate(sta_ids), left=diff_frm_mid,
+                         right=diff_frm_mid)
+
+
+class CoveragePlot(QtGui.QDialog):
+    '''
+    Dialog for the station by day coverage heatmap
+    '''
+
+    def __init__(self, parent=None, coverage=None):
+        super(CoveragePlot, self).__init__(parent)
+        self.setWindowTitle('Data Coverage')
+
+        self.coverage = coverage
+
+        self.initUI()
+        self.plot_data()
+
+    def initUI(self):
+        vbox = QtGui.QVBoxLayout()
+        self.setLayout(vbox)
+
+        self.coverage_graph_view = pg.GraphicsLayoutWidget()
+
+        vbox.addWidget(self.coverage_graph_view)
+
+        self.show()
+
+    def dispMousePos(self, pos):
+        # Display the station, day and coverage under the mouse as a tooltip
+        try:
+            point = self.plot.vb.mapSceneToView(pos)
+            row = int(round(point.y()))
+            col = int((point.x() - self.coverage.first_day) // (24 * 60 * 60))
+            if 0 <= row < len(self.coverage.stations) and 0 <= col < self.coverage.n_days:
+                self.plot.setToolTip(self.coverage.stations[row] + " " + UTCDateTime(point.x()).date.isoformat() +
+                                     ": %.1f%%" % (100 * self.coverage.matrix[row, col]))
+        except:
+            pass
+
+    def plot_data(self):
+        y_axis_string = pg.AxisItem(orientation='left')
+        y_axis_string.setTicks([list(enumerate(self.coverage.stations))])
+
+        self.plot = self.coverage_graph_view.addPlot(0, 0,
+                                                     axisItems={'bottom': DateAxisItem(orientation='bottom',
+                                                                                       utcOffset=0),
+                                                                'left': y_axis_string})
+        self.plot.setMouseEnabled(x=True, y=False)
+        self.plot.scene().sigMouseMoved.connect(self.dispMousePos)
+
+        # red (no data) to green (complete)
+        colormap = pg.ColorMap([0.0, 0.5, 1.0], [(200, 30, 30, 255), (240, 200, 40, 255), (30, 160, 60, 255)])
+
+        # one pixel per station and day, the image x axis is the day
+        self.image = pg.ImageItem(self.coverage.matrix.T, levels=(0, 1), lut=colormap.getLookupTable(0.0, 1.0, 256))
+        self.image.setRect(QtCore.QRectF(self.coverage.first_day, -0.5, self.coverage.n_days * 24 * 60 * 60,
+                                         len(self.coverage.stations)))
+        self.plot.addItem(self.image)
+
+    def update_data(self, coverage):
+        # new coverage after updated gap results
+        self.coverage = coverage
+        self.image.setImage(self.coverage.matrix.T, levels=(0, 1))
+        self.image.setRect(QtCore.QRectF(self.coverage.first_day, -0.5, self.coverage.n_days * 24 * 60 * 60,
+                                         len(self.coverage.stations)))
+
+
+class TileReply(QtNetwork.QNetworkReply):
+    """
+    Network reply serving a map tile from the tile cache
+    """
 
-            # iterate through stations
-            for stn_key, chan_dict in self.rec_int_dict.iteritems():
-                if not stn_key in select_sta:
-                    continue
-                # iterate through channels
-                for chan_key, rec_list in chan_dict.iteritems():
-                    if not chan_key in select_comp:
-                        continue
-                    # iterate through gaps list
-                    for rec_entry in rec_list:
-                        diff_frm_mid = (rec_entry['rec_end'] - rec_entry['rec_start']) / 2.0
+    def __init__(self, request, data, parent=None):
+        QtNetwork.QNetworkReply.__init__(self, parent)
+        self._data = data
+        self._offset = 0
 
-                        diff_frm_mid_list.append(diff_frm_mid)
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(QtNetwork.QNetworkAccessManager.GetOperation)
+        self.setHeader(QtNetwork.QNetworkRequest.ContentTypeHeader, "image/png")
+        self.setHeader(QtNetwork.QNetworkRequest.ContentLengthHeader, len(data))
+        self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, 200)
+        self.open(QtCore.QIODevice.ReadOnly | QtCore.QIODevice.Unbuffered)
 
-                        rec_midpoints.append(rec_entry['rec_start'] + diff_frm_mid)
-                        sta_ids.append(get_sta_id(stn_key))
+        QtCore.QTimer.singleShot(0, self._finish)
 
-            # Plot Error bar data recording intervals
-            err = pg.ErrorBarItem(x=np.array(rec_midpoints), y=np.array(sta_ids), left=np.array(diff_frm_mid_list),
-                                  right=np.array(diff_frm_mid_list), beam=0.06)
+    def _finish(self):
+        self.metaDataChanged.emit()
+        self.readyRead.emit()
+        self.finished.emit()
 
-            self.plot.addItem(err)
+    def abort(self):
+        pass
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return len(self._data) - self._offset + QtNetwork.QNetworkReply.bytesAvailable(self)
+
+    def readData(self, max_size):
+        chunk = self._data[self._offset:self._offset + max_size]
+        self._offset += len(chunk)
+        return chunk
+
+
+class TileCacheNetworkAccessManager(QtNetwork.QNetworkAccessManager):
+    """
+    Answers requests for cached map tiles locally and passes everything else
+    on to the network
+    """
+
+    def __init__(self, tile_cache, tile_source, parent=None):
+        super(TileCacheNetworkAccessManager, self).__init__(parent)
+        self.tile_cache = tile_cache
+        self.tile_source = tile_source
+
+    def createRequest(self, operation, request, device=None):
+        if operation == QtNetwork.QNetworkAccessManager.GetOperation:
+            tile = self.tile_source.parse_url(str(request.url().toString()))
+            if tile is not None:
+                data = self.tile_cache.get(*tile)
+                if data is not None:
+                    return TileReply(request, data, parent=self)
+
+        return super(TileCacheNetworkAccessManager, self).createRequest(operation, request, device)
 
 
 class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
@@ -298,21 +585,38 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         Ui_MainWindow.__init__(self)
         self.setupUi(self)
 
+        # seconds between consecutive waveforms before it is reported as a gap/overlap
+        self.gap_tolerance = GAP_TOLERANCE
+        # worker processes of a full gap analysis, split by station (QC_EVENTS_GAP_PROCESSES)
+        self.gap_processes = GAP_PROCESSES
+
         self.open_db_button.released.connect(self.open_db_file)
         self.open_cat_button.released.connect(self.open_cat_file)
         self.open_xml_button.released.connect(self.open_xml_file)
 
         self.action_upd_xml_sql.triggered.connect(self.upd_xml_sql)
+        self.action_generate_sql.triggered.connect(self.generate_sql)
+        self.action_refresh_sql.triggered.connect(self.refresh_db)
         self.action_get_gaps_sql.triggered.connect(self.get_gaps_sql)
         self.action_plot_gaps_overlaps.triggered.connect(self.plot_gaps_overlaps)
+        self.action_plot_coverage.triggered.connect(self.plot_coverage)
+        self.action_filter_cat.triggered.connect(self.filter_cat)
+        self.action_prefetch_tiles.triggered.connect(self.prefetch_map_tiles)
 
         self.station_view.itemClicked.connect(self.station_view_itemClicked)
 
+        # prefetched tiles are served from the tile cache, everything else goes through a bounded http cache
+        self.tile_cache = TileCache()
+        self.tile_source = DEFAULT_TILE_SOURCE
+        network_manager = TileCacheNetworkAccessManager(self.tile_cache, self.tile_source, parent=self)
         cache = QtNetwork.QNetworkDiskCache()
-        cache.setCacheDirectory("cache")
-        self.web_view.page().networkAccessManager().setCache(cache)
-        self.web_view.page().networkAccessManager()
+        cache.setCacheDirectory(os.path.join(MAP_CACHE_DIR, "http"))
+        cache.setMaximumCacheSize(HTTP_CACHE_MAX_BYTES)
+        network_manager.setCache(cache)
+        self.web_view.page().setNetworkAccessManager(network_manager)
 
+        # map.html only loads the javascript/css from lib/, fail here rather than show a blank map
+        check_map_assets()
         self.web_view.page().mainFrame().addToJavaScriptWindowObject("MainWindow", self)
         self.web_view.page().setLinkDelegationPolicy(QtWebKit.QWebPage.DelegateAllLinks)
         self.web_view.load(QtCore.QUrl('map.html'))
@@ -326,11 +630,38 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         with open('map.js', 'r') as f:
             frame = self.web_view.page().mainFrame()
             frame.evaluateJavaScript(f.read())
+            frame.evaluateJavaScript("setTileSource('{url}', '{subdomains}');".format(
+                url=self.tile_source.url_template, subdomains=self.tile_source.subdomains))
+
+    def prefetch_map_tiles(self):
+        # download the map tiles around the inventory into the offline tile cache
+        if not hasattr(self, 'station_coords'):
+            print("Open a StationXML file first")
+            return
+
+        zoom_text, ok = QtGui.QInputDialog.getText(self, "Prefetch Map Tiles", "Zoom levels (e.g. 0-8,10):",
+                                                   text="0-8")
+        if not ok:
+            return
+
+        # pad the station bounding box by 2 degrees (as for the reference station request)
+        bbox = (min(self.station_coords[0]) - 2, max(self.station_coords[0]) + 2,
+                min(self.station_coords[1]) - 2, max(self.station_coords[1]) + 2)
+
+        print("\nPrefetching map tiles for: " + str(bbox))
+        counts = prefetch_tiles(self.tile_source, self.tile_cache, bbox, parse_zooms(str(zoom_text)))
+        print("Fetched %s tiles, %s already cached, %s failed" % counts)
 
     @QtCore.pyqtSlot(float, float, str, str, int)
     def onMap_marker_selected(self, lat, lng, event_id, df_id, row_index):
         self.table_view_highlight(self.tbl_view_dict[str(df_id)], row_index)
 
+    @QtCore.pyqtSlot(str, str)
+    def onMap_markers_selected(self, df_id, row_indices_json):
+        # box selection on the map, the row indices come across as one json list
+        self.table_view_highlight_rows(self.tbl_view_dict[str(df_id)], json.loads(str(row_indices_json)),
+                                       update_map=False)
+
     @QtCore.pyqtSlot(int)
     def onMap_stn_marker_selected(self, station):
         self.station_view.setCurrentItem(self.station_view.topLevelItem(0))
@@ -346,7 +677,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.db_filename = str(QtGui.QFileDialog.getOpenFileName(
             parent=self, caption="Choose SQLite Database File",
             directory=os.path.expanduser("~"),
-            filter="Database Files (*.db *.json)"))
+            filter="Database Files (*.db *.json *.wfidx)"))
         if not self.db_filename:
             return
 
@@ -363,18 +694,77 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
             self.Session = sessionmaker(bind=self.engine)
             self.session = self.Session()
 
+            # add the station/component/starttime indexes to databases created before they existed
+            migrate_db(self.engine)
+
             print("SQLite Initializing Done!")
 
         elif os.path.splitext(self.db_filename)[1] == ".json":
 
-            with open(self.db_filename, 'r') as f:
+            # index the entries by (station, component, starttime) once, the dictionary is not kept
+            self.waveform_index = WaveformIndex.from_json(self.db_filename)
+
+            print("JSON --> Waveform Index Load Done!")
+
+        elif os.path.splitext(self.db_filename)[1] == ".wfidx":
+
+            # memory map the compact waveform index
+            self.waveform_index = WaveformIndex.open(self.db_filename)
 
-                # json_load = json.load(f)
-                self.network_dict = json.load(f)
+            print("Waveform Index Load Done!")
 
-            print("JSON --> Dictionary Load Done!")
+        # gap/overlap/interval results and coverage heatmap saved by a previous run, none from the
+        # previously opened database
+        self.gap_results = None
+        if os.path.exists(gap_results_filename(self.db_filename)):
+            self.gap_results = GapResults.load(gap_results_filename(self.db_filename))
+            print("Loaded gap results for " + str(len(self.gap_results)) + " channels")
+        self.coverage = None
+        if os.path.exists(coverage_filename(self.db_filename)):
+            self.coverage = CoverageMatrix.load(coverage_filename(self.db_filename))
 
-                # self.network_dict = json.loads(json_load)
+    def generate_sql(self):
+        # scan a miniSEED archive into a new waveform database
+        archive_dir = str(QtGui.QFileDialog.getExistingDirectory(
+            parent=self, caption="Choose miniSEED Archive Directory",
+            directory=os.path.expanduser("~")))
+        if not archive_dir:
+            return
+
+        db_filename = str(QtGui.QFileDialog.getSaveFileName(
+            parent=self, caption="Save Waveform Database",
+            directory=os.path.expanduser("~"),
+            filter="Database Files (*.db *.json)"))
+        if not db_filename:
+            return
+
+        print('')
+        print("Scanning miniSEED headers in: " + archive_dir)
+        index_archive(archive_dir, db_filename)
+
+    def refresh_db(self):
+        # rescan only the new, changed and deleted files of the archive into the open database
+        try:
+            db_ext = os.path.splitext(self.db_filename)[1]
+        except AttributeError:
+            print("Open a waveform database first")
+            return
+        if db_ext not in (".db", ".json"):
+            print("Only .db and .json databases can be refreshed, rebuild the index from its source")
+            return
+
+        archive_dir = str(QtGui.QFileDialog.getExistingDirectory(
+            parent=self, caption="Choose miniSEED Archive Directory",
+            directory=os.path.expanduser("~")))
+        if not archive_dir:
+            return
+
+        print('')
+        print("Refreshing " + self.db_filename + " from: " + archive_dir)
+        index_archive(archive_dir, self.db_filename, incremental=True)
+
+        if db_ext == ".json":
+            self.waveform_index = WaveformIndex.from_json(self.db_filename)
 
     def open_cat_file(self):
         self.cat_filename = str(QtGui.QFileDialog.getOpenFileName(
@@ -384,28 +774,15 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         if not self.cat_filename:
             return
 
-        self.cat = read_events(self.cat_filename)
-
-        # create empty data frame
-        self.cat_df = pd.DataFrame(data=None, columns=['event_id', 'qtime', 'lat', 'lon', 'depth', 'mag'])
-
-        # iterate through the events
-        for _i, event in enumerate(self.cat):
-            # Get quake origin info
-            origin_info = event.preferred_origin() or event.origins[0]
+        # stream the event columns out of the QuakeML (or the parsed catalogue cache)
+        self.cat_df = read_catalogue_cached(self.cat_filename)
 
-            try:
-                mag_info = event.preferred_magnitude() or event.magnitudes[0]
-                magnitude = mag_info.mag
-            except IndexError:
-                # No magnitude for event
-                magnitude = None
-
-            self.cat_df.loc[_i] = [str(event.resource_id.id).split('=')[1], int(origin_info.time.timestamp),
-                                   origin_info.latitude, origin_info.longitude,
-                                   origin_info.depth / 1000, magnitude]
+        # make UTC string from earthquake cat and add julian day column
+        add_time_columns(self.cat_df)
 
-        self.cat_df.reset_index(drop=True, inplace=True)
+        # sorted indexes for filtering, the table and map show the filtered view
+        self.cat_index = CatalogueIndex(self.cat_df)
+        self.cat_view_df = self.cat_df
 
         print('------------')
         print(self.cat_df)
@@ -523,9 +900,9 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         focus_widget = QtGui.QApplication.focusWidget()
         # get the selected row number
         row_number = focus_widget.selectionModel().selectedRows()[0].row()
-        row_index = self.table_accessor[focus_widget][1][row_number]
+        row_index = self.table_accessor[focus_widget][1].data_row(row_number)
 
-        self.selected_row = self.cat_df.loc[row_index]
+        self.selected_row = self.cat_view_df.loc[row_index]
 
         self.rc_menu = QtGui.QMenu(self)
         self.rc_menu.addAction('Open Earthquake with SG2K', functools.partial(
@@ -537,13 +914,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
         self.table_accessor = None
 
-        dropped_cat_df = self.cat_df
-
-        # make UTC string from earthquake cat and add julian day column
-        def mk_cat_UTC_str(row):
-            return (pd.Series([UTCDateTime(row['qtime']).ctime(), UTCDateTime(row['qtime']).julday]))
-
-        dropped_cat_df[['Q_time_str', 'julday']] = dropped_cat_df.apply(mk_cat_UTC_str, axis=1)
+        dropped_cat_df = self.cat_view_df
 
         self.tbld = TableDialog(parent=self, cat_df=dropped_cat_df)
 
@@ -554,7 +925,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.tbl_view_dict = {"cat": self.tbld.cat_event_table_view}
 
         # Create a new table_accessor dictionary for this class
-        self.table_accessor = {self.tbld.cat_event_table_view: [dropped_cat_df, range(0, len(dropped_cat_df))]}
+        self.table_accessor = {self.tbld.cat_event_table_view: [dropped_cat_df, self.tbld.cat_model]}
 
         self.tbld.cat_event_table_view.clicked.connect(self.table_view_clicked)
 
@@ -563,65 +934,109 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
     def headerClicked(self, logicalIndex):
         focus_widget = QtGui.QApplication.focusWidget()
-        table_df = self.table_accessor[focus_widget][0]
+        table_model = self.table_accessor[focus_widget][1]
 
         header = focus_widget.horizontalHeader()
 
+        # reorder the view through the model's sort permutation, the data frame is not moved
         self.order = header.sortIndicatorOrder()
-        table_df.sort_values(by=table_df.columns[logicalIndex],
-                             ascending=self.order, inplace=True)
-
-        self.table_accessor[focus_widget][1] = table_df.index.tolist()
-
-        if focus_widget == self.tbld.cat_event_table_view:
-            self.model = PandasModel(table_df, cat_nm=True)
-
-        focus_widget.setModel(self.model)
-        focus_widget.update()
+        table_model.sort(logicalIndex, self.order)
 
     def table_view_clicked(self):
         focus_widget = QtGui.QApplication.focusWidget()
-        row_number = focus_widget.selectionModel().selectedRows()[0].row()
-        row_index = self.table_accessor[focus_widget][1][row_number]
-        # Highlight/Select the current row in the table
-        self.table_view_highlight(focus_widget, row_index)
+        table_model = self.table_accessor[focus_widget][1]
+        row_indices = [table_model.data_row(index.row()) for index in focus_widget.selectionModel().selectedRows()]
+        if len(row_indices) == 1:
+            # Highlight/Select the current row in the table
+            self.table_view_highlight(focus_widget, row_indices[0])
+        elif len(row_indices) > 1:
+            self.table_view_highlight_rows(focus_widget, row_indices)
 
     def table_view_highlight(self, focus_widget, row_index):
 
         if focus_widget == self.tbld.cat_event_table_view:
-            self.selected_row = self.cat_df.loc[row_index]
+            self.selected_row = self.cat_view_df.loc[row_index]
 
             # Find the row_number of this index
-            cat_row_number = self.table_accessor[focus_widget][1].index(row_index)
+            cat_row_number = self.table_accessor[focus_widget][1].view_row(row_index)
             focus_widget.selectRow(cat_row_number)
 
             # Highlight the marker on the map
             js_call = "highlightEvent('{event_id}');".format(event_id=self.selected_row['event_id'])
             self.web_view.page().mainFrame().evaluateJavaScript(js_call)
 
+    def table_view_highlight_rows(self, focus_widget, row_indices, update_map=True):
+        # select several rows in the table and highlight their markers with a single map call
+
+        if focus_widget == self.tbld.cat_event_table_view:
+            table_model = self.table_accessor[focus_widget][1]
+
+            selection = QtGui.QItemSelection()
+            for row_index in row_indices:
+                view_row = table_model.view_row(row_index)
+                selection.select(table_model.index(view_row, 0),
+                                 table_model.index(view_row, table_model.columnCount() - 1))
+            focus_widget.selectionModel().select(selection, QtGui.QItemSelectionModel.ClearAndSelect)
+
+            if update_map:
+                event_ids = self.cat_view_df['event_id'].values[row_indices].astype(str).tolist()
+                js_call = "highlightEvents({event_ids});".format(event_ids=json.dumps(event_ids))
+                self.web_view.page().mainFrame().evaluateJavaScript(js_call)
+
+    def filter_cat(self):
+        if not hasattr(self, 'cat_index'):
+            return
+
+        filt_dlg = CatFilterDialog(parent=self)
+        if filt_dlg.exec_():
+            bounds = filt_dlg.getBounds()
+
+            self.cat_view_df = self.cat_index.filter(**bounds)
+            print("\nFiltered Catalogue: %s of %s Events" % (len(self.cat_view_df), len(self.cat_df)))
+
+            self.tbld.close()
+            self.build_tables()
+
+            self.web_view.page().mainFrame().evaluateJavaScript("clearEvents();")
+            self.plot_events()
+
+    def add_markers_js(self, js_func, rows, js_args=""):
+        # send the marker rows to the map in chunks of MARKER_CHUNK_SIZE, one bridge call per chunk
+        frame = self.web_view.page().mainFrame()
+        for chunk_start in range(0, len(rows), MARKER_CHUNK_SIZE):
+            js_call = "{js_func}({js_args}{rows});".format(
+                js_func=js_func, js_args=js_args,
+                rows=json.dumps(rows[chunk_start:chunk_start + MARKER_CHUNK_SIZE]))
+            frame.evaluateJavaScript(js_call)
+
     def plot_events(self):
-        # Plot the events
-        for row_index, row in self.cat_df.iterrows():
-            js_call = "addEvent('{event_id}', '{df_id}', {row_index}, " \
-                      "{latitude}, {longitude}, '{a_color}', '{p_color}');" \
-                .format(event_id=row['event_id'], df_id="cat", row_index=int(row_index), latitude=row['lat'],
-                        longitude=row['lon'], a_color="Red",
-                        p_color="#008000")
-            self.web_view.page().mainFrame().evaluateJavaScript(js_call)
+        # Large catalogues are drawn on a single clustered canvas layer instead of one marker per event
+        render_mode = "canvas" if len(self.cat_view_df) > CANVAS_EVENT_THRESHOLD else "svg"
+        self.web_view.page().mainFrame().evaluateJavaScript("setEventRenderMode('%s');" % render_mode)
+
+        # Plot the events, serialise the marker columns once
+        event_rows = zip(self.cat_view_df['event_id'].astype(str).tolist(),
+                         range(len(self.cat_view_df)),
+                         self.cat_view_df['lat'].tolist(),
+                         self.cat_view_df['lon'].tolist())
+
+        self.add_markers_js("addEvents", [list(row) for row in event_rows],
+                            js_args="'{df_id}', '{a_color}', '{p_color}', ".format(df_id="cat", a_color="Red",
+                                                                                   p_color="#008000"))
 
     def plot_inv(self):
         # plot the stations
         temp_x_coords = []
         temp_y_coords = []
+        station_rows = []
         for i, station in enumerate(self.inv[0]):
             # append the lats and lons to temp lists
             temp_x_coords.append(station.longitude)
             temp_y_coords.append(station.latitude)
 
-            js_call = "addStation('{station_id}', {latitude}, {longitude});" \
-                .format(station_id=station.code, latitude=station.latitude,
-                        longitude=station.longitude)
-            self.web_view.page().mainFrame().evaluateJavaScript(js_call)
+            station_rows.append([station.code, station.latitude, station.longitude])
+
+        self.add_markers_js("addStations", station_rows)
 
         self.station_coords = (temp_x_coords, temp_y_coords)
 
@@ -655,11 +1070,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
             if os.path.splitext(self.db_filename)[1] == ".db":
                 # run SQL query
-                for matched_entry in self.session.query(Waveforms). \
-                        filter(or_(and_(Waveforms.starttime <= query_time, query_time < Waveforms.endtime),
-                                   and_(query_time <= Waveforms.starttime, Waveforms.starttime < query_time + 30 * 60)),
-                               Waveforms.station.in_(select_sta),
-                               Waveforms.component.in_(select_comp)):
+                for matched_entry in event_window_query(self.session, query_time, select_sta, select_comp):
                     print(matched_entry.ASDF_tag)
 
                     # read in the data to obspy
@@ -673,29 +1084,25 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                     st_dict[temp_tr.get_id()].append(temp_tr)
 
 
-            if os.path.splitext(self.db_filename)[1] == ".json":
-                # run python dictionary query
-                for key, matched_entry in self.network_dict.iteritems():
-                    if ((matched_entry['starttime'] <= query_time < matched_entry['endtime']) \
-                                or (
-                                query_time <= matched_entry['starttime'] and matched_entry['starttime'] < query_time + (
-                            30 * 60))) \
-                            and ((matched_entry['station'] in select_sta) and (
-                                matched_entry['component'] in select_comp)):
-                        print(matched_entry['ASDF_tag']) #, os.path.join(matched_entry['path'], key))
+            if os.path.splitext(self.db_filename)[1] in WAVEFORM_INDEX_EXTS:
+                # run waveform index query
+                for row in self.waveform_index.window_query(query_time, select_sta, select_comp):
+                    matched_entry = self.waveform_index.entry(row)
+                    key = matched_entry['waveform_basename']
+                    print(matched_entry['ASDF_tag']) #, os.path.join(matched_entry['path'], key))
 
-                        # read in the data to obspy
-                        temp_st = read(os.path.join(matched_entry['path'], key))
+                    # read in the data to obspy
+                    temp_st = read(os.path.join(matched_entry['path'], key))
 
-                        # modify network header
-                        temp_tr = temp_st[0]
-                        temp_tr.stats.network = matched_entry['new_network']
+                    # modify network header
+                    temp_tr = temp_st[0]
+                    temp_tr.stats.network = matched_entry['new_network']
 
-                        # trim trace to start and endtime
-                        temp_tr.trim(starttime=trace_starttime, endtime=trace_endtime)
+                    # trim trace to start and endtime
+                    temp_tr.trim(starttime=trace_starttime, endtime=trace_endtime)
 
-                        # st.append(temp_tr)
-                        st_dict[temp_tr.get_id()].append(temp_tr)
+                    # st.append(temp_tr)
+                    st_dict[temp_tr.get_id()].append(temp_tr)
 
             # free memory
             temp_st = None
@@ -835,7 +1242,6 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         # iterate through stations
 
         print("\nQuerying SQLite database for start/end dates for each station")
-        print("This may take a while.......")
 
         def overwrite_info(st, et):
             # fix the station inventory
@@ -847,35 +1253,22 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                 self.inv[0][i][_j].start_date = st
                 self.inv[0][i][_j].end_date = et
 
-        for i, station_obj in enumerate(self.inv[0]):
-            station = station_obj.code
-            comp_regex = re.compile('..Z')
+        # the extents of all stations in a single pass over the database
+        if os.path.splitext(self.db_filename)[1] == ".db":
+            station_extents = dict((station, (st, et)) for station, st, et in station_extents_query(self.session))
 
-            if os.path.splitext(self.db_filename)[1] == ".db":
+        elif os.path.splitext(self.db_filename)[1] in WAVEFORM_INDEX_EXTS:
+            station_extents = self.waveform_index.station_extents(re.compile('..Z'))
 
-                for min_max in self.session.query(func.min(Waveforms.starttime), func.max(Waveforms.endtime)). \
-                        filter(Waveforms.station == station, Waveforms.component.like('__Z')):
-                    start_time = UTCDateTime(min_max[0])
-                    end_time = UTCDateTime(min_max[1])
-
-            elif os.path.splitext(self.db_filename)[1] == ".json":
-                temp_extent = []
-                for key, matched_entry in self.network_dict.iteritems():
-                    if (matched_entry['station'] == station) and re.match(comp_regex, matched_entry['component']):
-                        if len(temp_extent) == 0:
-                            # first iteration
-                            temp_extent = [matched_entry['starttime'], matched_entry['endtime']]
-                            continue
-
-                        # check the current iterate
-                        if (matched_entry['starttime'] < temp_extent[0]):
-                            temp_extent[0] = matched_entry['starttime']
+        for i, station_obj in enumerate(self.inv[0]):
+            station = station_obj.code
 
-                        if (matched_entry['endtime'] > temp_extent[1]):
-                            temp_extent[1] = matched_entry['endtime']
+            if station_extents.get(station) is None:
+                print("\nNo recordings for: " + station)
+                continue
 
-                start_time = UTCDateTime(temp_extent[0])
-                end_time = UTCDateTime(temp_extent[1])
+            start_time = UTCDateTime(station_extents[station][0])
+            end_time = UTCDateTime(station_extents[station][1])
 
             print("\nRecording interval for: " + station)
             print("\tStart Date: " + start_time.ctime())
@@ -888,180 +1281,79 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         print("\nFinished Updating StationXML file: " + self.stn_filename)
 
     def get_gaps_sql(self):
-        # go through SQL entries and find all gaps save them into dictionary
-        self.recording_gaps = {}
-        self.recording_overlaps = {}
-        self.recording_intervals = {}
+        # find all gaps/overlaps of the database, the results are kept as arrays in self.gap_results
+        prev_gap_results = getattr(self, 'gap_results', None)
 
         print('_________________')
 
-        print("\nIterating through SQL entries to find data gaps")
-        print("This may take a while......")
+        print("\nFinding data gaps and overlaps")
 
-        # iterate through stations
-        for _i, station in enumerate(self.station_list):
-            print "\r Working on Station: " + station + ", " + str(_i + 1) + " of " + \
-                  str(len(self.station_list)) + " Stations",
-            sys.stdout.flush()
-            self.recording_gaps[station] = {}
-            self.recording_overlaps[station] = {}
-            self.recording_intervals[station] = {}
-
-            # store for previous end time for a particular component in dictionary
-            comp_endtime_dict = {}
-            gaps_no_dict = {}
-            ovlps_no_dict = {}
-
-            # create new entry into recording gaps dict for each channel
-            for chan in self.channel_codes:
-                self.recording_gaps[station][chan] = []
-                self.recording_overlaps[station][chan] = []
-                self.recording_intervals[station][chan] = []
-                gaps_no_dict[chan] = 0
-                ovlps_no_dict[chan] = 0
+        # only the entries past the watermarks saved with the previous results are examined, the results are
+        # saved once below with their recording intervals
+        if os.path.splitext(self.db_filename)[1] == ".db":
+            # compared inside SQLite with LAG() where supported, only the gaps/overlaps come back
+            self.gap_results = update_gaps_overlaps(self.db_filename, tolerance=self.gap_tolerance,
+                                                    processes=self.gap_processes, save=False)
 
-            if os.path.splitext(self.db_filename)[1] == ".db":
-                for entry in (self.session.query(Waveforms)
-                                      .filter(Waveforms.station == station)
-                                      .order_by(Waveforms.starttime)):
-
-                    # print(entry.ASDF_tag)
-                    # print(UTCDateTime(entry.starttime).ctime())
-                    # print(UTCDateTime(entry.endtime).ctime())
-                    # print(entry.waveform_basename)
-                    # print(entry.path)
-
-                    # if there is a previous timestamp in the dict then calculate diff tween the previous endtime and the
-                    # currently iterated starttime
-                    if entry.component in comp_endtime_dict.keys():
-                        """
-                        This is where the algorithm to analyse gaps/overlaps would go
-                        for now it is just a simple analysis to find large data gaps (corresponding to service intervals)
-                        """
-
-                        prev_endtime = comp_endtime_dict[entry.component]
-
-                        diff = entry.starttime - prev_endtime
-
-                        # get large gap
-                        if diff > 1:
-                            gaps_no_dict[entry.component] += 1
-                            self.recording_gaps[station][entry.component].append({"gap_start": prev_endtime,
-                                                                                  "gap_end": entry.starttime})
-                            # print(UTCDateTime(prev_endtime).ctime(), UTCDateTime(entry.starttime).ctime())
-                        # check if overalp
-                        elif diff < -1:
-                            ovlps_no_dict[entry.component] += 1
-                            self.recording_overlaps[station][entry.component].append({"ovlp_start": entry.starttime,
-                                                                                      "ovlp_end": prev_endtime})
-
-                        # add current iterate to dictionary
-                        comp_endtime_dict[entry.component] = entry.endtime
-
-                    else:
-                        # there is no component in dictionary (i.e first iteration for component)
-                        # add current iterate to dictionary
-                        comp_endtime_dict[entry.component] = entry.endtime
-
-            elif os.path.splitext(self.db_filename)[1] == ".json":
-                # sort the dictionary by the starttime field
-                sorted_keys = sorted(self.network_dict, key=lambda x: self.network_dict[x]['starttime'])
-
-                for key in sorted_keys:
-                    entry = self.network_dict[key]
-                    if (entry['station'] == station):
-
-                        # print(entry['ASDF_tag'])
-                        # print(UTCDateTime(entry['starttime']).ctime())
-                        # print(UTCDateTime(entry['endtime']).ctime())
-                        # print(key)
-                        # print(entry['path'])
-
-                        # if there is a previous timestamp in the dict then calculate diff tween the previous endtime and the
-                        # currently iterated starttime
-                        if entry['component'] in comp_endtime_dict.keys():
-                            """
-                            This is where the algorithm to analyse gaps/overlaps would go
-                            for now it is just a simple analysis to find large data gaps (corresponding to service intervals)
-                            """
-
-                            prev_endtime = comp_endtime_dict[entry['component']]
-
-                            diff = entry['starttime'] - prev_endtime
-
-                            # get large gap
-                            if diff > 1:
-                                gaps_no_dict[entry['component']] += 1
-                                self.recording_gaps[station][entry['component']].append({"gap_start": prev_endtime,
-                                                                                         "gap_end": entry['starttime']})
-                                # print(UTCDateTime(prev_endtime).ctime(), UTCDateTime(entry['starttime).ctime())
-                            # check if overalp
-                            elif diff < -1:
-                                ovlps_no_dict[entry['component']] += 1
-                                self.recording_overlaps[station][entry['component']].append(
-                                    {"ovlp_start": entry['starttime'],
-                                     "ovlp_end": prev_endtime})
-
-                            # add current iterate to dictionary
-                            comp_endtime_dict[entry['component']] = entry['endtime']
+        elif os.path.splitext(self.db_filename)[1] in WAVEFORM_INDEX_EXTS:
+            self.gap_results = update_gaps_overlaps(self.db_filename, tolerance=self.gap_tolerance,
+                                                    index=self.waveform_index, processes=self.gap_processes,
+                                                    save=False)
 
-                        else:
-                            # there is no component in dictionary (i.e first iteration for component)
-                            # add current iterate to dictionary
-                            comp_endtime_dict[entry['component']] = entry['endtime']
+        self.calculate_recording_int()
 
-                            # # print("Found: ")
-                            # for chan in self.channel_codes:
-                            #     print("\tChannel: " + chan +" "+ str(gaps_no_dict[chan]) +
-                            #           " Gaps and " + str(ovlps_no_dict[chan]) + " Overlaps!")
+        # save the recording intervals along with the gaps/overlaps
+        self.gap_results.save(gap_results_filename(self.db_filename))
 
-        self.calculate_recording_int()
+        # only the rows of stations with new entries (and any new days) of the coverage heatmap are recomputed
+        if getattr(self, 'coverage', None) is not None:
+            self.coverage.update(self.gap_results, changed_stations(prev_gap_results, self.gap_results))
+            self.coverage.save(coverage_filename(self.db_filename))
+            if getattr(self, 'coverage_plot', None) is not None and self.coverage_plot.isVisible():
+                self.coverage_plot.update_data(self.coverage)
 
     def calculate_recording_int(self):
-        # iterate through stations
-        for i, station_obj in enumerate(self.inv[0]):
-            station = station_obj.code
-
-            # get the start_date and end_date for station recording
-            rec_start = self.inv[0][i].start_date.timestamp
-            rec_end = self.inv[0][i].end_date.timestamp
-
-            # store for previous end time for a particular component in dictionary
-            comp_endtime_dict = {}
-
-            # iterate through channels
-            for chan_key, gaps_list in self.recording_gaps[station].iteritems():
-                # iterate through gaps list
-                gaps_no = len(gaps_list)
-                for _j, gap_entry in enumerate(gaps_list):
-                    if _j == 0:
-                        # first interval
-                        # print(UTCDateTime(rec_start).ctime(), UTCDateTime(gap_entry['gap_start']).ctime())
-                        self.recording_intervals[station][chan_key].append({'rec_start': rec_start,
-                                                                            'rec_end': gap_entry['gap_start']})
-
-                    elif _j == gaps_no - 1:
-                        # last interval
-                        # print(UTCDateTime(gap_entry['gap_end']).ctime(), UTCDateTime(rec_end).ctime())
-                        self.recording_intervals[station][chan_key].append({'rec_start': gap_entry['gap_end'],
-                                                                            'rec_end': rec_end})
-
-                    else:
-                        if chan_key in comp_endtime_dict.keys():
-                            prev_endtime = comp_endtime_dict[chan_key]
-                            # print(UTCDateTime(gaps_list[_j-1]['gap_end']).ctime(), UTCDateTime(gap_entry['gap_start']).ctime())
-                            self.recording_intervals[station][chan_key].append({'rec_start': prev_endtime,
-                                                                                'rec_end': gap_entry['gap_start']})
-                    comp_endtime_dict[chan_key] = gap_entry['gap_end']
+        # get the start_date and end_date for station recording
+        rec_dates = dict((station_obj.code, (station_obj.start_date.timestamp, station_obj.end_date.timestamp))
+                         for station_obj in self.inv[0])
+
+        # the recording intervals of a channel are its station recording dates minus the gaps
+        for station, chan_key in self.gap_results.keys():
+            if station not in rec_dates:
+                continue
+            rec_start, rec_end = rec_dates[station]
+            self.gap_results.set_intervals(station, chan_key, complement(self.gap_results.gaps(station, chan_key),
+                                                                         int(rec_start), int(rec_end)))
 
         print("")
         print("\nFinished calculating station recording intervals")
         print("Produced output: ")
 
+        # time all channels of each station were recording
+        for station in self.gap_results.stations():
+            if station not in rec_dates:
+                continue
+            channels = [chan_key for stn_key, chan_key in self.gap_results.keys() if stn_key == station]
+            all_recording = intersection(*[self.gap_results.intervals(station, chan_key) for chan_key in channels])
+            print("\t" + station + ": " + "%.1f%%" % (100 * coverage(all_recording, *rec_dates[station])) +
+                  " recorded on all of " + ", ".join(channels))
+
+    def plot_coverage(self):
+        if getattr(self, 'coverage', None) is None:
+            if getattr(self, 'gap_results', None) is None:
+                print("\nNo gap results, run Get Gap Info frm SQL first")
+                return
+            self.coverage = CoverageMatrix.compute(self.gap_results)
+            self.coverage.save(coverage_filename(self.db_filename))
+        self.coverage_plot = CoveragePlot(parent=self, coverage=self.coverage)
+
     def plot_gaps_overlaps(self):
+        if getattr(self, 'gap_results', None) is None:
+            print("\nNo gap results, run Get Gap Info frm SQL first")
+            return
         self.data_avail_plot = DataAvailPlot(parent=self, sta_list=self.station_list,
                                              chan_list=self.channel_codes,
-                                             rec_int_dict=self.recording_intervals)
+                                             gap_results=self.gap_results)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,19 @@
 var map = L.map('map').setView([0, 0], 0);
-var layer = new L.StamenTileLayer("toner");
+var layer = L.tileLayer("http://{s}.tile.stamen.com/toner/{z}/{x}/{y}.png", {
+    subdomains: "abcd",
+    minZoom: 0,
+    maxZoom: 20,
+    attribution: 'Map tiles by <a href="http://stamen.com">Stamen Design</a>, under CC BY 3.0. ' +
+                 'Data by <a href="http://openstreetmap.org">OpenStreetMap</a>, under ODbL.'
+});
 map.addLayer(layer);
 
+// Swap the tile server, tiles are served from the offline tile cache by MainWindow when available
+function setTileSource(url_template, subdomains) {
+    layer.options.subdomains = subdomains;
+    layer.setUrl(url_template);
+}
+
 var activeIcon = L.divIcon({
     className: 'svg-marker',
     html: '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" style="margin: 0 auto; width: 20px; height:20px;"><polygon style="fill:Red; stroke:#666666; stroke-width:2; stroke-opacity:0.5"points="0,0 20,0 10,20"/></svg>',
@@ -32,6 +44,294 @@ var stations = {};
 
 var ref_stations = {};
 
+// Canvas event layer for large catalogues. All events are drawn on a single
+// canvas, nearby events are merged into grid clusters below clusterMaxZoom
+// and clicks are resolved through a grid hit-test index instead of per marker
+// listeners.
+var EventCanvasLayer = L.Class.extend({
+    options: {
+        radius: 6,
+        cellSize: 40,
+        clusterMaxZoom: 8
+    },
+
+    initialize: function(options) {
+        L.setOptions(this, options);
+        this.clear();
+    },
+
+    clear: function() {
+        this._ids = [];
+        this._dfIds = [];
+        this._rows = [];
+        this._latLngs = [];
+        this._colors = [];
+        this._index = {};
+        this._projZoom = null;
+        this._active = {};
+        this._hitGrid = {};
+        if (this._map) {
+            this._redraw();
+        }
+    },
+
+    addEvents: function(df_id, a_color, p_color, event_rows) {
+        for (var i = 0; i < event_rows.length; i++) {
+            var row = event_rows[i];
+            this._index[row[0]] = this._ids.length;
+            this._ids.push(row[0]);
+            this._dfIds.push(df_id);
+            this._rows.push(row[1]);
+            this._latLngs.push(L.latLng(row[2], row[3]));
+            this._colors.push([a_color, p_color]);
+        }
+        this._projZoom = null;
+        if (this._map) {
+            this._redraw();
+        }
+    },
+
+    hasEvent: function(event_id) {
+        return event_id in this._index;
+    },
+
+    setActive: function(event_ids) {
+        // only the active overlay canvas is redrawn on a selection change
+        this._active = {};
+        for (var k = 0; k < event_ids.length; k++) {
+            if (event_ids[k] in this._index) {
+                this._active[this._index[event_ids[k]]] = true;
+            }
+        }
+        this._redrawActive();
+    },
+
+    eventsInBounds: function(bounds) {
+        var rows = [];
+        for (var i = 0; i < this._latLngs.length; i++) {
+            if (bounds.contains(this._latLngs[i])) {
+                rows.push(i);
+            }
+        }
+        return rows;
+    },
+
+    onAdd: function(map) {
+        this._map = map;
+        this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+        this._canvas.style.pointerEvents = 'none';
+        map.getPanes().overlayPane.appendChild(this._canvas);
+        this._activeCanvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+        this._activeCanvas.style.pointerEvents = 'none';
+        map.getPanes().overlayPane.appendChild(this._activeCanvas);
+
+        map.on('moveend', this._redraw, this);
+        map.on('resize', this._redraw, this);
+        map.on('click', this._onClick, this);
+        this._redraw();
+    },
+
+    onRemove: function(map) {
+        map.getPanes().overlayPane.removeChild(this._canvas);
+        map.getPanes().overlayPane.removeChild(this._activeCanvas);
+        map.off('moveend', this._redraw, this);
+        map.off('resize', this._redraw, this);
+        map.off('click', this._onClick, this);
+        this._map = null;
+    },
+
+    _project: function() {
+        // absolute pixel coordinates are only recomputed when the zoom changes
+        var zoom = this._map.getZoom();
+        if (this._projZoom === zoom) {
+            return;
+        }
+        var n = this._latLngs.length;
+        this._px = new Float64Array(n);
+        this._py = new Float64Array(n);
+        for (var i = 0; i < n; i++) {
+            var p = this._map.project(this._latLngs[i], zoom);
+            this._px[i] = p.x;
+            this._py[i] = p.y;
+        }
+        this._projZoom = zoom;
+    },
+
+    _addHit: function(item) {
+        var key = Math.floor(item.x / this.options.cellSize) + ':' + Math.floor(item.y / this.options.cellSize);
+        if (!(key in this._hitGrid)) {
+            this._hitGrid[key] = [];
+        }
+        this._hitGrid[key].push(item);
+    },
+
+    _redraw: function() {
+        var map = this._map;
+        var size = map.getSize();
+        var canvas = this._canvas;
+        canvas.width = size.x;
+        canvas.height = size.y;
+        L.DomUtil.setPosition(canvas, map.containerPointToLayerPoint([0, 0]));
+
+        var ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, size.x, size.y);
+        this._hitGrid = {};
+
+        this._project();
+        var origin = map.getPixelBounds().min;
+        var r = this.options.radius;
+        var cellSize = this.options.cellSize;
+        var cluster = map.getZoom() < this.options.clusterMaxZoom;
+        var cells = {};
+        var i, x, y;
+
+        for (i = 0; i < this._ids.length; i++) {
+            x = this._px[i] - origin.x;
+            y = this._py[i] - origin.y;
+            if (x < -r || y < -r || x > size.x + r || y > size.y + r) {
+                continue;
+            }
+            if (cluster) {
+                var key = Math.floor(x / cellSize) + ':' + Math.floor(y / cellSize);
+                var cell = cells[key];
+                if (!cell) {
+                    cells[key] = {x: x, y: y, count: 1, first: i};
+                } else {
+                    cell.x += x;
+                    cell.y += y;
+                    cell.count += 1;
+                }
+            } else {
+                this._drawEvent(ctx, i, x, y, false);
+                this._addHit({x: x, y: y, event: i});
+            }
+        }
+
+        if (cluster) {
+            for (var cell_key in cells) {
+                var c = cells[cell_key];
+                if (c.count == 1) {
+                    this._drawEvent(ctx, c.first, c.x, c.y, false);
+                    this._addHit({x: c.x, y: c.y, event: c.first});
+                } else {
+                    c.x /= c.count;
+                    c.y /= c.count;
+                    this._drawCluster(ctx, c);
+                    this._addHit({x: c.x, y: c.y, count: c.count});
+                }
+            }
+        }
+
+        this._redrawActive();
+    },
+
+    _redrawActive: function() {
+        // active events are drawn on their own canvas on top of the others
+        var map = this._map;
+        if (!map) {
+            return;
+        }
+        var size = map.getSize();
+        var canvas = this._activeCanvas;
+        canvas.width = size.x;
+        canvas.height = size.y;
+        L.DomUtil.setPosition(canvas, map.containerPointToLayerPoint([0, 0]));
+
+        var ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, size.x, size.y);
+
+        this._project();
+        var origin = map.getPixelBounds().min;
+        for (var i in this._active) {
+            this._drawEvent(ctx, +i, this._px[i] - origin.x, this._py[i] - origin.y, true);
+        }
+    },
+
+    _drawEvent: function(ctx, i, x, y, active) {
+        ctx.beginPath();
+        ctx.arc(x, y, this.options.radius, 0, 2 * Math.PI);
+        ctx.globalAlpha = active ? 0.5 : 0.3;
+        ctx.fillStyle = this._colors[i][active ? 0 : 1];
+        ctx.fill();
+        ctx.globalAlpha = active ? 0.8 : 0.6;
+        ctx.strokeStyle = this._colors[i][active ? 0 : 1];
+        ctx.lineWidth = 2;
+        ctx.stroke();
+        ctx.globalAlpha = 1;
+    },
+
+    _drawCluster: function(ctx, c) {
+        var radius = this.options.radius + 3 * Math.log(c.count);
+        ctx.beginPath();
+        ctx.arc(c.x, c.y, radius, 0, 2 * Math.PI);
+        ctx.globalAlpha = 0.6;
+        ctx.fillStyle = "#008000";
+        ctx.fill();
+        ctx.globalAlpha = 1;
+        ctx.fillStyle = "White";
+        ctx.font = "11px sans-serif";
+        ctx.textAlign = "center";
+        ctx.textBaseline = "middle";
+        ctx.fillText(c.count, c.x, c.y);
+    },
+
+    _hitTest: function(point) {
+        // look in the clicked grid cell and its neighbours for the nearest item
+        var cellSize = this.options.cellSize;
+        var cx = Math.floor(point.x / cellSize);
+        var cy = Math.floor(point.y / cellSize);
+        var best = null;
+        var bestDist = Infinity;
+        for (var dx = -1; dx <= 1; dx++) {
+            for (var dy = -1; dy <= 1; dy++) {
+                var items = this._hitGrid[(cx + dx) + ':' + (cy + dy)] || [];
+                for (var k = 0; k < items.length; k++) {
+                    var item = items[k];
+                    var reach = item.count ? this.options.radius + 3 * Math.log(item.count) : this.options.radius;
+                    var dist = Math.sqrt(Math.pow(item.x - point.x, 2) + Math.pow(item.y - point.y, 2));
+                    if (dist <= reach && dist < bestDist) {
+                        best = item;
+                        bestDist = dist;
+                    }
+                }
+            }
+        }
+        return best;
+    },
+
+    _onClick: function(e) {
+        var item = this._hitTest(e.containerPoint);
+        if (item === null) {
+            return;
+        }
+        if (item.count) {
+            // expand the cluster
+            this._map.setView(this._map.containerPointToLatLng([item.x, item.y]), this._map.getZoom() + 2);
+            return;
+        }
+        var i = item.event;
+        var latlng = this._latLngs[i];
+        L.popup().setLatLng(latlng).setContent(this._ids[i]).openOn(this._map);
+        if (typeof MainWindow != 'undefined') {
+            MainWindow.onMap_marker_selected(latlng.lat, latlng.lng, this._ids[i], this._dfIds[i], this._rows[i]);
+        }
+    }
+});
+
+var eventCanvas = null;
+
+// "svg" draws one CircleMarker per event, "canvas" draws all events on the canvas layer
+var eventRenderMode = "svg";
+
+function setEventRenderMode(mode) {
+    clearEvents();
+    eventRenderMode = mode;
+    if (mode == "canvas" && eventCanvas === null) {
+        eventCanvas = new EventCanvasLayer();
+        map.addLayer(eventCanvas);
+    }
+}
+
 
 function addRefStation(station_id, latitude, longitude) {
     var marker = L.marker([latitude, longitude], {
@@ -76,6 +376,23 @@ function addStation(station_id, latitude, longitude) {
     setStnMarkerInactive(stations[station_id]);
 }
 
+// Bulk versions of addStation/addEvent, take one array of marker rows per call
+function addStations(station_rows) {
+    _.forEach(station_rows, function(row) {
+        addStation(row[0], row[1], row[2]);
+    });
+}
+
+function addEvents(df_id, a_color, p_color, event_rows) {
+    if (eventRenderMode == "canvas") {
+        eventCanvas.addEvents(df_id, a_color, p_color, event_rows);
+        return;
+    }
+    _.forEach(event_rows, function(row) {
+        addEvent(row[0], df_id, row[1], row[2], row[3], a_color, p_color);
+    });
+}
+
 function addEvent(event_id, df_id, row_index, latitude, longitude, a_color, p_color) {
     var marker = new L.CircleMarker(
         L.latLng(latitude, longitude), {
@@ -111,6 +428,17 @@ function addEvent(event_id, df_id, row_index, latitude, longitude, a_color, p_co
 }
 
 
+function clearEvents() {
+    _.forEach(events, function(value, key) {
+        map.removeLayer(value.marker);
+    });
+    events = {};
+    if (eventCanvas !== null) {
+        eventCanvas.clear();
+    }
+}
+
+
 function setMarkerActive(value) {
     if (value.marker.status != "active") {
         value.marker.setStyle({color: value.active_color, opacity: 0.8, fillOpacity: 0.5});
@@ -132,6 +460,7 @@ function setAllInactive() {
     _.forEach(events, function(value, key) {
         setMarkerInactive(value);
     });
+    activeEvents = {};
 }
 
 
@@ -142,12 +471,105 @@ function setAllActive() {
 }
 
 
+// ids of the currently highlighted events, only these are restyled on a selection change
+var activeEvents = {};
+
+function highlightEvents(event_ids) {
+    if (eventRenderMode == "canvas") {
+        eventCanvas.setActive(event_ids);
+        return;
+    }
+    var new_active = {};
+    _.forEach(event_ids, function(event_id) {
+        if (event_id in events) {
+            new_active[event_id] = true;
+        }
+    });
+    _.forEach(activeEvents, function(value, event_id) {
+        if (!(event_id in new_active) && (event_id in events)) {
+            setMarkerInactive(events[event_id]);
+        }
+    });
+    _.forEach(new_active, function(value, event_id) {
+        setMarkerActive(events[event_id]);
+    });
+    activeEvents = new_active;
+}
+
 function highlightEvent(event_id) {
-    setAllInactive();
-    var value = events[event_id];
-    setMarkerActive(value)
+    highlightEvents([event_id]);
+}
+
+
+// Ctrl + drag draws a selection box, the events inside it are sent to MainWindow in one call.
+// The mousedown is caught in the capture phase on the map container, before the map pane's
+// L.Draggable starts panning, and the box follows the mouse through document listeners
+// until the button is released (as L.Map.BoxZoom does)
+var selectBox = null;
+
+function boxSelectStart(e) {
+    if (!e.ctrlKey || e.button !== 0) {
+        return;
+    }
+    L.DomEvent.stop(e);
+    var latlng = map.mouseEventToLatLng(e);
+    selectBox = L.rectangle(L.latLngBounds(latlng, latlng), {weight: 1, color: "Red", fillOpacity: 0.1});
+    selectBox.startLatLng = latlng;
+    selectBox.addTo(map);
+
+    L.DomEvent.on(document, "mousemove", boxSelectMove);
+    L.DomEvent.on(document, "mouseup", boxSelectEnd);
+}
+
+function boxSelectMove(e) {
+    if (selectBox !== null) {
+        selectBox.setBounds(L.latLngBounds(selectBox.startLatLng, map.mouseEventToLatLng(e)));
+    }
 }
 
+function boxSelectEnd(e) {
+    L.DomEvent.off(document, "mousemove", boxSelectMove);
+    L.DomEvent.off(document, "mouseup", boxSelectEnd);
+    if (selectBox === null) {
+        return;
+    }
+    var bounds = selectBox.getBounds();
+    map.removeLayer(selectBox);
+    selectBox = null;
+
+    // the click that follows the mouseup would otherwise select the event under the cursor
+    var container = map.getContainer();
+    container.addEventListener("click", L.DomEvent.stop, true);
+    setTimeout(function() {
+        container.removeEventListener("click", L.DomEvent.stop, true);
+    }, 0);
+
+    var df_id = "cat";
+    var event_ids = [];
+    var row_indices = [];
+    if (eventRenderMode == "canvas") {
+        _.forEach(eventCanvas.eventsInBounds(bounds), function(i) {
+            df_id = eventCanvas._dfIds[i];
+            event_ids.push(eventCanvas._ids[i]);
+            row_indices.push(eventCanvas._rows[i]);
+        });
+    } else {
+        _.forEach(events, function(value, event_id) {
+            if (bounds.contains(value.marker.getLatLng())) {
+                df_id = value.marker.myCustomDfID;
+                event_ids.push(event_id);
+                row_indices.push(value.marker.myCustomRowID);
+            }
+        });
+    }
+    highlightEvents(event_ids);
+    if (typeof MainWindow != 'undefined') {
+        MainWindow.onMap_markers_selected(df_id, JSON.stringify(row_indices));
+    }
+}
+
+map.getContainer().addEventListener("mousedown", boxSelectStart, true);
+
 function resetMarkerSize() {
     _.forEach(events, function(value, key) {
         value.marker.setRadius(10);
@@ -183,7 +605,7 @@ function setStnMarkerInactive(value) {
         if (value.icon_q == "ref") {
         value.marker.setIcon(passiveRefIcon);
         } else if (value.icon_q == "temp") {
-        value.setIcon(passiveIcon);
+        value.marker.setIcon(passiveIcon);
         };
         value.marker.setZIndexOffset(100 - pos.y);
         value.marker.status = "passive";
@@ -194,6 +616,7 @@ function setStnAllInactive() {
     _.forEach(stations, function(value, key) {
         setStnMarkerInactive(value);
     });
+    activeStation = null;
 }
 
 
@@ -204,16 +627,25 @@ function setStnAllActive() {
 }
 
 
+// currently highlighted station (or reference station) marker
+var activeStation = null;
+
+function setActiveStation(value) {
+    if (activeStation !== null && activeStation !== value) {
+        setStnMarkerInactive(activeStation);
+    }
+    if (value) {
+        setStnMarkerActive(value);
+    }
+    activeStation = value || null;
+}
+
 function highlightStation(station_id) {
-    setStnAllInactive();
-    var value = stations[station_id];
-    setStnMarkerActive(value)
+    setActiveStation(stations[station_id]);
 }
 
 function highlightRefStation(station_id) {
-    setStnAllInactive();
-    var value = ref_stations[station_id];
-    setStnMarkerActive(value)
+    setActiveStation(ref_stations[station_id]);
 }
 
 //function stationClick(e) {
@@ -0,0 +1,47 @@
+"""
+Regression test of the vectorised catalogue time columns against the
+per-row UTCDateTime path they replaced.
+
+Usage:
+    python -m unittest test_catalogue
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+
+from catalogue import add_time_columns
+
+N_EVENTS = 100000
+
+
+class AddTimeColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # 1900 to 2100, with day boundaries, leap days and the epoch included
+        qtime = rng.randint(-2208988800, 4102444800, size=N_EVENTS).astype(np.int64)
+        qtime[:6] = [0, -1, 86399, 86400, 951782400, 4102444799]
+        self.cat_df = pd.DataFrame({'qtime': qtime})
+
+    def test_matches_utcdatetime(self):
+        def mk_cat_UTC_str(row):
+            return (pd.Series([UTCDateTime(row['qtime']).ctime(), UTCDateTime(row['qtime']).julday]))
+
+        expected = self.cat_df.apply(mk_cat_UTC_str, axis=1)
+        result = add_time_columns(self.cat_df.copy())
+
+        self.assertEqual(result['Q_time_str'].tolist(), expected[0].tolist())
+        self.assertEqual(result['julday'].tolist(), expected[1].astype(np.int64).tolist())
+
+    def test_empty_catalogue(self):
+        result = add_time_columns(self.cat_df.iloc[:0].copy())
+
+        self.assertEqual(len(result), 0)
+        self.assertEqual(result['Q_time_str'].dtype, object)
+        self.assertEqual(result['julday'].dtype, np.int64)
+
+
+if __name__ == '__main__':
+    unittest.main()
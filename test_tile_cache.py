@@ -0,0 +1,138 @@
+"""
+Tile prefetch and LRU cache checks against a local stand-in tile server.
+
+Usage:
+    python -m unittest test_tile_cache
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from tile_cache import TileCache, TileSource, prefetch_tiles, tiles_for_bbox, check_map_assets, MAP_ASSETS
+
+TILE_BYTES = 1000
+
+
+def fake_tile(z, x, y):
+    return ('%d/%d/%d;' % (z, x, y)).encode('ascii').ljust(TILE_BYTES, b'.')
+
+
+class FakeTileHandler(BaseHTTPRequestHandler):
+    """
+    Serves /z/x/y.png with a tile identifying its coordinates, 404 for
+    anything else, and counts the requests
+    """
+
+    requests = []
+
+    def do_GET(self):
+        FakeTileHandler.requests.append(self.path)
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or not parts[2].endswith('.png'):
+            self.send_error(404)
+            return
+        data = fake_tile(int(parts[0]), int(parts[1]), int(parts[2][:-len('.png')]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeTileHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.source = TileSource('http://127.0.0.1:%d/{z}/{x}/{y}.png' % cls.server.server_address[1], timeout=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        FakeTileHandler.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_source_url(self):
+        self.assertEqual(self.source.parse_url(self.source.url(3, 4, 5)), (3, 4, 5))
+
+    def test_prefetch(self):
+        cache = TileCache(self.cache_dir, max_bytes=10 ** 6)
+        bbox = (-10.0, 10.0, -10.0, 10.0)
+        tiles = list(tiles_for_bbox(bbox[0], bbox[1], bbox[2], bbox[3], range(0, 5)))
+
+        self.assertEqual(prefetch_tiles(self.source, cache, bbox, range(0, 5)), (len(tiles), 0, 0))
+        for tile in tiles:
+            self.assertEqual(cache.get(*tile), fake_tile(*tile))
+
+        # a second prefetch is served from the cache, also after reopening it
+        n_requests = len(FakeTileHandler.requests)
+        reopened = TileCache(self.cache_dir, max_bytes=10 ** 6)
+        self.assertEqual(prefetch_tiles(self.source, reopened, bbox, range(0, 5)), (0, len(tiles), 0))
+        self.assertEqual(len(FakeTileHandler.requests), n_requests)
+        self.assertEqual(reopened.total_bytes, len(tiles) * TILE_BYTES)
+
+    def test_missing_tiles(self):
+        source = TileSource('http://127.0.0.1:%d/missing/{z}/{x}/{y}.png' % self.server.server_address[1])
+        cache = TileCache(self.cache_dir)
+        self.assertEqual(prefetch_tiles(source, cache, (-1.0, 1.0, -1.0, 1.0), [0]), (0, 0, 1))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TileCache(self.cache_dir, max_bytes=10 * TILE_BYTES, low_water=0.5)
+        for y in range(10):
+            cache.put(5, 0, y, self.source.fetch(5, 0, y))
+        self.assertEqual(len(cache), 10)
+
+        # tile 0 is used again, so 1 to 6 are evicted down to half of max_bytes
+        cache.get(5, 0, 0)
+        cache.put(5, 0, 10, self.source.fetch(5, 0, 10))
+
+        self.assertEqual(cache.total_bytes, 5 * TILE_BYTES)
+        self.assertEqual([y for y in range(11) if (5, 0, y) in cache], [0, 7, 8, 9, 10])
+        for y in range(11):
+            self.assertEqual(os.path.exists(cache.tile_path(5, 0, y)), (5, 0, y) in cache)
+
+    def test_full_cache_put_is_not_quadratic(self):
+        cache = TileCache(self.cache_dir, max_bytes=100 * TILE_BYTES)
+        data = fake_tile(0, 0, 0)
+        start = time.time()
+        for y in range(3000):
+            cache.put(12, 0, y, data)
+        elapsed = time.time() - start
+        self.assertLessEqual(cache.total_bytes, cache.max_bytes)
+        self.assertEqual(len(cache), len(os.listdir(os.path.join(self.cache_dir, '12', '0'))))
+        # one tile tree walk per put took seconds for this
+        self.assertLess(elapsed, 2.0)
+
+    def test_check_map_assets(self):
+        self.assertRaises(IOError, check_map_assets, self.cache_dir)
+        for rel_path, _ in MAP_ASSETS:
+            path = os.path.join(self.cache_dir, rel_path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+        check_map_assets(self.cache_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+"""
+Offline support for the Leaflet map: a size bounded LRU cache of map tiles,
+a prefetcher that fills it for a bounding box and the download of the
+javascript/css assets used by map.html.
+
+Usage:
+    python tile_cache.py assets
+    python tile_cache.py prefetch MINLON MAXLON MINLAT MAXLAT --zooms 0-8
+"""
+import argparse
+import math
+import os
+import re
+from collections import OrderedDict
+
+try:
+    from urllib2 import urlopen, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import URLError
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Map cache location and size limits (override with environment variables)
+MAP_CACHE_DIR = os.environ.get('QC_EVENTS_MAP_CACHE_DIR', os.path.join(PACKAGE_DIR, "cache"))
+TILE_CACHE_MAX_BYTES = int(os.environ.get('QC_EVENTS_TILE_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('QC_EVENTS_HTTP_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+
+# fraction of the tile cache max_bytes it is evicted down to once full
+TILE_CACHE_LOW_WATER = 0.9
+
+# Javascript/css used by map.html, served from lib/ in the package
+ASSETS_DIR = os.path.join(PACKAGE_DIR, "lib")
+MAP_ASSETS = [
+    ("leaflet/leaflet.js", "http://cdn.leafletjs.com/leaflet-0.7/leaflet.js"),
+    ("leaflet/leaflet.css", "http://cdn.leafletjs.com/leaflet-0.7/leaflet.css"),
+    ("leaflet/images/layers.png", "http://cdn.leafletjs.com/leaflet-0.7/images/layers.png"),
+    ("leaflet/images/layers-2x.png", "http://cdn.leafletjs.com/leaflet-0.7/images/layers-2x.png"),
+    ("leaflet/images/marker-icon.png", "http://cdn.leafletjs.com/leaflet-0.7/images/marker-icon.png"),
+    ("leaflet/images/marker-icon-2x.png", "http://cdn.leafletjs.com/leaflet-0.7/images/marker-icon-2x.png"),
+    ("leaflet/images/marker-shadow.png", "http://cdn.leafletjs.com/leaflet-0.7/images/marker-shadow.png"),
+    ("lodash/lodash.min.js", "http://cdnjs.cloudflare.com/ajax/libs/lodash.js/3.10.0/lodash.min.js")]
+
+
+class TileSource(object):
+    """
+    A slippy map tile server described by a Leaflet style url template,
+    e.g. "http://{s}.tile.stamen.com/toner/{z}/{x}/{y}.png"
+    """
+
+    def __init__(self, url_template, subdomains='', timeout=30):
+        self.url_template = url_template
+        self.subdomains = subdomains
+        self.timeout = timeout
+
+        # regex to recognise urls of this source and pull out the tile coordinates
+        pattern = re.escape(url_template)
+        for key, group in [('s', '[^./]+'), ('z', '(?P<z>\\d+)'), ('x', '(?P<x>\\d+)'), ('y', '(?P<y>\\d+)')]:
+            pattern = pattern.replace(re.escape('{%s}' % key), group)
+        self.url_regex = re.compile('^' + pattern + '$')
+
+    def url(self, z, x, y):
+        subdomain = self.subdomains[(x + y) % len(self.subdomains)] if self.subdomains else ''
+        return self.url_template.format(s=subdomain, z=z, x=x, y=y)
+
+    def parse_url(self, url):
+        """
+        Return the (z, x, y) of a tile url of this source or None
+        """
+        match = self.url_regex.match(url)
+        if match is None:
+            return None
+        return int(match.group('z')), int(match.group('x')), int(match.group('y'))
+
+    def fetch(self, z, x, y):
+        response = urlopen(self.url(z, x, y), timeout=self.timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+# Tiles used by the map (the Stamen toner layer)
+DEFAULT_TILE_SOURCE = TileSource("http://{s}.tile.stamen.com/toner/{z}/{x}/{y}.png", subdomains='abcd')
+
+
+class TileCache(object):
+    """
+    Tiles stored as cache_dir/z/x/y.png, the total size is kept below
+    max_bytes by removing the least recently used tiles first
+
+    The tiles are listed once when the cache is opened into an in-memory
+    index ordered from least to most recently used, so a put into a full
+    cache does not walk the tile tree. Eviction goes down to low_water of
+    max_bytes, a prefetch into a full cache evicts in batches rather than
+    on every tile.
+    """
+
+    def __init__(self, cache_dir=os.path.join(MAP_CACHE_DIR, "tiles"), max_bytes=TILE_CACHE_MAX_BYTES,
+                 low_water=TILE_CACHE_LOW_WATER):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # path -> size, least recently used first
+        self._index = OrderedDict((path, size) for _, size, path in sorted(self._entries()))
+        self.total_bytes = sum(self._index.values())
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), "%d.png" % y)
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if name.endswith('.png'):
+                    path = os.path.join(dirpath, name)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _touch(self, path, size):
+        # move to the most recently used end of the index
+        self.total_bytes -= self._index.pop(path, 0)
+        self._index[path] = size
+        self.total_bytes += size
+
+    def _forget(self, path):
+        self.total_bytes -= self._index.pop(path, 0)
+
+    def __contains__(self, tile):
+        return self.tile_path(*tile) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, z, x, y):
+        path = self.tile_path(z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            # removed by another process
+            self._forget(path)
+            return None
+        # mark as recently used, the mtime keeps the order for the next time the cache is opened
+        os.utime(path, None)
+        self._touch(path, len(data))
+        return data
+
+    def put(self, z, x, y, data):
+        path = self.tile_path(z, x, y)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._touch(path, len(data))
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used tiles until the cache fits in low_water
+        of max_bytes
+        """
+        target = int(self.max_bytes * self.low_water)
+        while self._index and self.total_bytes > target:
+            path, size = self._index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                # already removed by another process
+                pass
+
+
+def lonlat_to_tile(lon, lat, z):
+    # standard web mercator tile numbering
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bbox(min_lon, max_lon, min_lat, max_lat, zooms):
+    """
+    Yield the (z, x, y) of every tile covering the bounding box at the zoom levels
+    """
+    for z in zooms:
+        x0, y0 = lonlat_to_tile(min_lon, max_lat, z)
+        x1, y1 = lonlat_to_tile(max_lon, min_lat, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+def parse_zooms(text):
+    """
+    Parse zoom levels given as e.g. "0-6,8,10"
+    """
+    zooms = []
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-')
+            zooms.extend(range(int(start), int(end) + 1))
+        elif part:
+            zooms.append(int(part))
+    return sorted(set(zooms))
+
+
+def prefetch_tiles(source, cache, bbox, zooms, refresh=False):
+    """
+    Download all tiles for bbox (min_lon, max_lon, min_lat, max_lat) at the
+    zoom levels into the cache, returns (fetched, cached, failed) counts
+    """
+    fetched, cached, failed = 0, 0, 0
+    for z, x, y in tiles_for_bbox(bbox[0], bbox[1], bbox[2], bbox[3], zooms):
+        if not refresh and (z, x, y) in cache:
+            cached += 1
+            continue
+        try:
+            cache.put(z, x, y, source.fetch(z, x, y))
+            fetched += 1
+        except (URLError, IOError) as e:
+            print("Failed to fetch tile %s/%s/%s: %s" % (z, x, y, e))
+            failed += 1
+    return fetched, cached, failed
+
+
+def check_map_assets(assets_dir=ASSETS_DIR):
+    """
+    Raise IOError if any javascript/css used by map.html is missing, the
+    map has no CDN fallback so it would not load
+    """
+    missing = [rel_path for rel_path, _ in MAP_ASSETS if not os.path.exists(os.path.join(assets_dir, rel_path))]
+    if missing:
+        raise IOError("Map assets missing from %s: %s. Run 'python tile_cache.py assets' on a machine with "
+                      "internet access and copy lib/ with the package" % (assets_dir, ', '.join(missing)))
+
+
+def fetch_map_assets(assets_dir=ASSETS_DIR, refresh=False):
+    """
+    Download the javascript/css used by map.html so the map works offline
+    """
+    for rel_path, url in MAP_ASSETS:
+        path = os.path.join(assets_dir, rel_path)
+        if os.path.exists(path) and not refresh:
+            continue
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        print("Downloading " + url)
+        response = urlopen(url, timeout=30)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prepare the QC Events map for offline use")
+    subparsers = parser.add_subparsers(dest='command')
+
+    assets_parser = subparsers.add_parser('assets', help="download the map javascript/css into lib/")
+    assets_parser.add_argument('--refresh', action='store_true')
+
+    prefetch_parser = subparsers.add_parser('prefetch', help="download map tiles for a bounding box")
+    prefetch_parser.add_argument('bbox', nargs=4, type=float, metavar=('MINLON', 'MAXLON', 'MINLAT', 'MAXLAT'))
+    prefetch_parser.add_argument('--zooms', default='0-8', help="zoom levels, e.g. 0-6,8")
+    prefetch_parser.add_argument('--url', default=DEFAULT_TILE_SOURCE.url_template, help="tile url template")
+    prefetch_parser.add_argument('--subdomains', default=DEFAULT_TILE_SOURCE.subdomains)
+    prefetch_parser.add_argument('--cache-dir', default=os.path.join(MAP_CACHE_DIR, "tiles"))
+    prefetch_parser.add_argument('--max-bytes', type=int, default=TILE_CACHE_MAX_BYTES)
+    prefetch_parser.add_argument('--refresh', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.command == 'assets':
+        fetch_map_assets(refresh=args.refresh)
+    elif args.command == 'prefetch':
+        counts = prefetch_tiles(TileSource(args.url, subdomains=args.subdomains),
+                                TileCache(args.cache_dir, max_bytes=args.max_bytes),
+                                args.bbox, parse_zooms(args.zooms), refresh=args.refresh)
+        print("Fetched %s tiles, %s already cached, %s failed" % counts)
@@ -0,0 +1,303 @@
+"""
+Compact, memory-mappable index of the waveform database.
+
+The entries are held as a numpy structured array sorted by (station,
+component, starttime) so that each (station, component) channel is a
+contiguous slice with sorted start times. Time window queries become binary
+searches on that slice, bounded by the longest waveform duration of the
+channel.
+
+String fields are interned: the records hold small integer codes into one
+string table per field, only the waveform basenames are stored per entry.
+
+The index is saved as a single .wfidx file (a JSON header followed by the
+aligned arrays) which is opened with np.memmap, so opening it is near
+instant and the pages are shared between processes.
+
+Usage:
+    python waveform_index.py convert DATABASE.json|DATABASE.db INDEX.wfidx
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import struct
+
+import numpy as np
+
+ENTRY_FIELDS = ['starttime', 'endtime', 'orig_network', 'new_network', 'station', 'component',
+                'location', 'path', 'ASDF_tag']
+
+# string fields stored as codes into a string table
+INTERNED_FIELDS = ['orig_network', 'new_network', 'station', 'component', 'location', 'path', 'ASDF_tag']
+
+RECORD_DTYPE = np.dtype([('starttime', '<i8'), ('endtime', '<i8'),
+                         ('orig_network', '<u2'), ('new_network', '<u2'), ('station', '<u2'),
+                         ('component', '<u2'), ('location', '<u2'), ('path', '<u4'), ('ASDF_tag', '<u4')])
+
+WFIDX_MAGIC = b'QCWFIDX1'
+WFIDX_ALIGN = 64
+
+
+def _to_str(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def replace_file(temp_filename, filename):
+    """
+    Move temp_filename over filename, atomically on POSIX (Windows refuses
+    to rename onto an existing file, so it is removed first there)
+    """
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temp_filename, filename)
+
+
+class WaveformIndex(object):
+
+    def __init__(self, records, tables, basenames, groups=None):
+        """
+        records is a RECORD_DTYPE array sorted by (station, component,
+        starttime), tables maps each interned field to its string table and
+        basenames holds the waveform basename of every record
+        """
+        self.records = records
+        self.tables = tables
+        self.basenames = basenames
+        self.starttime = records['starttime']
+        self.endtime = records['endtime']
+        self.n = len(records)
+
+        if groups is None:
+            groups = self._find_groups()
+
+        # (station, component) -> (lo, hi, max_duration) of the contiguous channel slice
+        self.groups = {}
+        # station -> list of components
+        self.station_components = {}
+        for station, component, lo, hi, max_duration in groups:
+            self.groups[(station, component)] = (lo, hi, max_duration)
+            self.station_components.setdefault(station, []).append(component)
+
+    def _find_groups(self):
+        if self.n == 0:
+            return []
+        station = self.records['station']
+        component = self.records['component']
+        boundaries = np.flatnonzero((station[1:] != station[:-1]) | (component[1:] != component[:-1])) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [self.n]))
+        max_durations = np.maximum.reduceat(self.endtime - self.starttime, starts)
+        return [(_to_str(self.tables['station'][station[lo]]), _to_str(self.tables['component'][component[lo]]),
+                 lo, hi, max_duration)
+                for lo, hi, max_duration in zip(starts.tolist(), ends.tolist(), max_durations.tolist())]
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Build the index from a dict of equal length sequences with the
+        ENTRY_FIELDS and waveform_basename, in any order
+        """
+        n = len(columns['waveform_basename'])
+        records = np.empty(n, dtype=RECORD_DTYPE)
+        records['starttime'] = np.asarray(columns['starttime'], dtype=np.int64)
+        records['endtime'] = np.asarray(columns['endtime'], dtype=np.int64)
+
+        tables = {}
+        for field in INTERNED_FIELDS:
+            table, codes = np.unique(np.asarray(columns[field], dtype=np.str_), return_inverse=True)
+            if len(table) > np.iinfo(RECORD_DTYPE[field]).max:
+                raise ValueError("Too many distinct values for %s" % field)
+            tables[field] = table
+            records[field] = codes.ravel()
+
+        order = np.lexsort((records['starttime'], records['component'], records['station']))
+        basenames = np.asarray(columns['waveform_basename'], dtype=np.str_)[order]
+        return cls(records[order], tables, basenames)
+
+    @classmethod
+    def from_network_dict(cls, network_dict):
+        """
+        Build the index from the {basename: entry} dictionary of a JSON database
+        """
+        keys = list(network_dict.keys())
+        columns = {'waveform_basename': keys}
+        for field in ENTRY_FIELDS:
+            columns[field] = [network_dict[key][field] for key in keys]
+        return cls.from_columns(columns)
+
+    @classmethod
+    def from_json(cls, json_filename):
+        with open(json_filename, 'r') as f:
+            return cls.from_network_dict(json.load(f))
+
+    @classmethod
+    def from_sqlite(cls, db_filename):
+        """
+        Build the index from the Waveforms table of a SQLite database
+        """
+        fields = ENTRY_FIELDS + ['waveform_basename']
+        conn = sqlite3.connect(db_filename)
+        try:
+            rows = conn.execute("SELECT %s FROM waveforms" % ', '.join(fields)).fetchall()
+        finally:
+            conn.close()
+        return cls.from_columns(dict((field, [row[i] for row in rows]) for i, field in enumerate(fields)))
+
+    def save(self, filename):
+        """
+        Write the index as a .wfidx file
+        """
+        arrays = [('records', np.ascontiguousarray(self.records)),
+                  ('basenames', np.ascontiguousarray(self.basenames, dtype=np.bytes_))]
+        for field in INTERNED_FIELDS:
+            arrays.append(('table_' + field, np.ascontiguousarray(
+                np.char.encode(np.asarray(self.tables[field], dtype=np.str_), 'utf-8'))))
+
+        groups = [[station, component, lo, hi, max_duration]
+                  for (station, component), (lo, hi, max_duration) in sorted(self.groups.items())]
+
+        # the header is written with placeholder offsets first to know its size
+        sections = dict((name, {'offset': 0, 'dtype': array.dtype.str if array.dtype.names is None else 'records',
+                                'shape': list(array.shape)}) for name, array in arrays)
+        header = {'n': self.n, 'sections': sections, 'groups': groups}
+        header_len = len(json.dumps(header).encode('utf-8')) + 32 * len(arrays)
+
+        offset = len(WFIDX_MAGIC) + 8 + header_len
+        for name, array in arrays:
+            offset += -offset % WFIDX_ALIGN
+            sections[name]['offset'] = offset
+            offset += array.nbytes
+
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_len)
+
+        with open(filename, 'wb') as f:
+            f.write(WFIDX_MAGIC)
+            f.write(struct.pack('<Q', header_len))
+            f.write(header_bytes)
+            for name, array in arrays:
+                f.seek(sections[name]['offset'])
+                f.write(array.tobytes())
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Open a .wfidx file, the arrays are memory mapped read only
+        """
+        with open(filename, 'rb') as f:
+            if f.read(len(WFIDX_MAGIC)) != WFIDX_MAGIC:
+                raise ValueError("Not a waveform index file: %s" % filename)
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+
+        def section(name):
+            info = header['sections'][name]
+            dtype = RECORD_DTYPE if info['dtype'] == 'records' else np.dtype(str(info['dtype']))
+            if info['shape'][0] == 0:
+                return np.empty(info['shape'], dtype=dtype)
+            return np.memmap(filename, dtype=dtype, mode='r', offset=info['offset'], shape=tuple(info['shape']))
+
+        tables = dict((field, np.char.decode(np.asarray(section('table_' + field)), 'utf-8'))
+                      for field in INTERNED_FIELDS)
+        groups = [tuple(group) for group in header['groups']]
+        return cls(section('records'), tables, section('basenames'), groups=groups)
+
+    def entry(self, row):
+        """
+        Return the database entry of a row as a dictionary (the same fields as
+        a JSON database entry plus waveform_basename)
+        """
+        record = self.records[row]
+        entry = dict((field, _to_str(self.tables[field][record[field]])) for field in INTERNED_FIELDS)
+        entry['starttime'] = int(record['starttime'])
+        entry['endtime'] = int(record['endtime'])
+        entry['waveform_basename'] = _to_str(self.basenames[row])
+        return entry
+
+    def channel_rows(self, station, component, t0, t1):
+        """
+        Rows of a channel whose starttime lies in [t0, t1), found by binary search
+        """
+        lo, hi, max_duration = self.groups.get((station, component), (0, 0, 0))
+        first = lo + int(np.searchsorted(self.starttime[lo:hi], t0, side='left'))
+        last = lo + int(np.searchsorted(self.starttime[lo:hi], t1, side='left'))
+        return np.arange(first, last)
+
+    def window_query(self, query_time, stations, components, window=30 * 60):
+        """
+        Rows recording at query_time or starting within window seconds after
+        it, the same selection as waveforms_db.event_window_query
+        """
+        rows = []
+        for station in stations:
+            for component in components:
+                if (station, component) not in self.groups:
+                    continue
+                max_duration = self.groups[(station, component)][2]
+                # nothing starting before query_time - max_duration can still be recording
+                candidates = self.channel_rows(station, component, query_time - max_duration, query_time + window)
+                st = self.starttime[candidates]
+                et = self.endtime[candidates]
+                match = ((st <= query_time) & (query_time < et)) | \
+                        ((query_time <= st) & (st < query_time + window))
+                rows.append(candidates[match])
+
+        if len(rows) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(rows)
+
+    def station_extents(self, comp_regex=None):
+        """
+        {station: (min starttime, max endtime)} over the channels whose
+        component matches comp_regex, computed for all stations at once
+        """
+        if self.n == 0:
+            return {}
+        keys = sorted(self.groups, key=lambda key: self.groups[key][0])
+        los = np.array([self.groups[key][0] for key in keys], dtype=np.int64)
+        # channels are sorted by starttime so the first start is the channel minimum
+        first_start = self.starttime[los].tolist()
+        max_end = np.maximum.reduceat(self.endtime, los).tolist()
+
+        extents = {}
+        for (station, component), st, et in zip(keys, first_start, max_end):
+            if comp_regex is not None and not re.match(comp_regex, component):
+                continue
+            if station in extents:
+                st = min(st, extents[station][0])
+                et = max(et, extents[station][1])
+            extents[station] = (st, et)
+        return extents
+
+
+def open_waveform_index(filename):
+    """
+    Open a .wfidx file or build the index from a .json or .db database
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext == '.wfidx':
+        return WaveformIndex.open(filename)
+    elif ext == '.json':
+        return WaveformIndex.from_json(filename)
+    elif ext == '.db':
+        return WaveformIndex.from_sqlite(filename)
+    raise ValueError("Unknown waveform database format: %s" % filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Waveform index tools")
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser('convert', help="convert a .json or .db database into a .wfidx index")
+    convert_parser.add_argument('source')
+    convert_parser.add_argument('dest')
+
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        index = open_waveform_index(args.source)
+        index.save(args.dest)
+        print("Wrote %s entries to %s (%.1f MB)" % (index.n, args.dest, os.path.getsize(args.dest) / 1e6))
@@ -0,0 +1,367 @@
+"""
+Build the waveform database of a miniSEED archive.
+
+Only the miniSEED headers are read (obspy headonly), spread across a process
+pool, and the rows are written to the Waveforms table with batched bulk
+inserts or to a JSON database.
+
+The size and mtime of every scanned file are stored alongside (the
+archive_files table or a .files.json sidecar of a JSON database) so that an
+incremental run only scans new or changed files and drops deleted ones.
+
+Usage:
+    python waveform_indexer.py ARCHIVE_DIR DATABASE.db|DATABASE.json [--processes N] [--network XX] [--incremental]
+"""
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import time
+
+from obspy import read
+from sqlalchemy import create_engine, and_, bindparam
+
+try:
+    from obspy.io.mseed import ObsPyMSEEDError
+except ImportError:
+    # obspy < 1.1
+    from obspy.io.mseed import InternalMSEEDReadingError as ObsPyMSEEDError
+
+from waveform_index import replace_file
+from waveforms_db import Base, Waveforms, ArchiveFiles
+
+# number of rows per bulk insert
+INSERT_BATCH_SIZE = 5000
+
+# bound parameters per lookup, below the 999 of older sqlite builds
+LOOKUP_BATCH_SIZE = 500
+
+ASDF_TAG = "raw_recording"
+
+# raised by obspy for unreadable, truncated or non miniSEED files
+MSEED_READ_ERRORS = (ObsPyMSEEDError, IOError, OSError, ValueError)
+
+
+def walk_archive(archive_dir, pattern='*'):
+    """
+    Yield the path of every file below archive_dir matching pattern
+    """
+    for dirpath, dirnames, filenames in os.walk(archive_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if fnmatch.fnmatch(name, pattern):
+                yield os.path.join(dirpath, name)
+
+
+def file_fingerprints(paths):
+    """
+    Return {path: (size, mtime)} for the files
+    """
+    fingerprints = {}
+    for path in paths:
+        stat = os.stat(path)
+        fingerprints[path] = (stat.st_size, stat.st_mtime)
+    return fingerprints
+
+
+def archive_delta(current, stored):
+    """
+    Compare the current and stored fingerprints, returns the sorted lists of
+    (new, changed, deleted) file paths
+    """
+    new = sorted(path for path in current if path not in stored)
+    changed = sorted(path for path in current if path in stored and tuple(stored[path]) != tuple(current[path]))
+    deleted = sorted(path for path in stored if path not in current)
+    return new, changed, deleted
+
+
+class ScanError(Exception):
+    """
+    Raised when the miniSEED headers of an archive file can not be read
+    """
+    pass
+
+
+def scan_file(path, new_network=None):
+    """
+    Read the miniSEED headers of a file and return its Waveforms row as a
+    dictionary, None if the file holds no traces. Raises ScanError if the
+    file can not be read
+    """
+    try:
+        st = read(path, format='MSEED', headonly=True)
+    except MSEED_READ_ERRORS as e:
+        raise ScanError("%s: %s" % (type(e).__name__, e))
+    if len(st) == 0:
+        return None
+
+    stats = st[0].stats
+    starttime = min(tr.stats.starttime for tr in st)
+    endtime = max(tr.stats.endtime for tr in st)
+    new_network = new_network or stats.network
+
+    return {'starttime': int(starttime.timestamp),
+            'endtime': int(endtime.timestamp),
+            'orig_network': stats.network,
+            'new_network': new_network,
+            'station': stats.station,
+            'component': stats.channel,
+            'location': stats.location,
+            'waveform_basename': os.path.basename(path),
+            'path': os.path.dirname(path),
+            'ASDF_tag': "{net}.{sta}.{loc}.{cha}__{start}__{end}__{tag}".format(
+                net=new_network, sta=stats.station, loc=stats.location, cha=stats.channel,
+                start=starttime.strftime('%Y-%m-%dT%H:%M:%S'), end=endtime.strftime('%Y-%m-%dT%H:%M:%S'),
+                tag=ASDF_TAG)}
+
+
+def _scan_file_star(args):
+    # (path, row, error) so failures are reported by the parent process
+    try:
+        return args[0], scan_file(*args), None
+    except ScanError as e:
+        return args[0], None, str(e)
+
+
+def scan_files(paths, processes=None, new_network=None, chunksize=64, failed=None):
+    """
+    Scan files across a process pool, yields the rows of the readable files.
+    The paths of the files that could not be read are logged and appended
+    to the failed list
+    """
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        for path, row, error in pool.imap_unordered(_scan_file_star, ((path, new_network) for path in paths),
+                                                    chunksize=chunksize):
+            if error is not None:
+                print("Failed to read %s: %s" % (path, error))
+                if failed is not None:
+                    failed.append(path)
+            elif row is not None:
+                yield row
+    finally:
+        pool.close()
+        pool.join()
+
+
+def batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def drop_duplicate_basenames(batch, claimed, stored_paths, duplicates):
+    """
+    waveform_basename is the database key, so only one archive file per
+    basename can be stored. Returns the rows of batch to write: a basename
+    stored for another file by an earlier run keeps that file, within a scan
+    the smallest path wins so that a rebuild does not depend on the scan
+    order. claimed maps the basenames written by this scan to their file
+    path, stored_paths the basenames of batch already in the database. The
+    paths left out are reported and appended to duplicates
+    """
+    keep = {}
+    for row in batch:
+        basename = row['waveform_basename']
+        path = os.path.join(row['path'], basename)
+        if basename in claimed:
+            if claimed[basename] == path:
+                keep[basename] = row
+                continue
+            loser, winner = max(path, claimed[basename]), min(path, claimed[basename])
+        elif basename in stored_paths and stored_paths[basename] != path:
+            loser, winner = path, stored_paths[basename]
+        else:
+            loser, winner = None, path
+
+        if loser is not None:
+            print("Duplicate basename, %s is not indexed as %s is stored under %s" % (loser, winner, basename))
+            duplicates.append(loser)
+        if winner == path:
+            claimed[basename] = path
+            keep[basename] = row
+    return list(keep.values())
+
+
+def read_fingerprints(db_filename):
+    """
+    Return the stored {path: (size, mtime)} of a .db or .json database
+    """
+    if os.path.splitext(db_filename)[1] == ".json":
+        try:
+            with open(db_filename + '.files.json', 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    if not os.path.exists(db_filename):
+        return {}
+    engine = create_engine('sqlite:///' + db_filename)
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        table = ArchiveFiles.__table__
+        return dict((row[0], (row[1], row[2]))
+                    for row in conn.execute(table.select().with_only_columns(table.c.file_path, table.c.size,
+                                                                             table.c.mtime)))
+
+
+def write_sqlite(rows, db_filename, fingerprints, removed=(), replace_all=False, failed=(), duplicates=None,
+                 batch_size=INSERT_BATCH_SIZE):
+    """
+    Apply a scan to the Waveforms and archive_files tables in one transaction:
+    the entries of the removed file paths are deleted, then rows and
+    fingerprints are written with one bulk insert per batch. failed holds the
+    paths the scan could not read, it is only complete once rows is exhausted.
+    Files sharing a basename with another file are not written (see
+    drop_duplicate_basenames) and appended to duplicates. The fingerprints of
+    the failed and duplicate paths are not stored so the next incremental run
+    retries them. Returns the number of rows written
+    """
+    engine = create_engine('sqlite:///' + db_filename)
+    Base.metadata.create_all(engine)
+
+    waveforms = Waveforms.__table__
+    archive_files = ArchiveFiles.__table__
+
+    if duplicates is None:
+        duplicates = []
+    with engine.begin() as conn:
+        if replace_all:
+            conn.execute(waveforms.delete())
+            conn.execute(archive_files.delete())
+
+        for batch in batched(removed, batch_size):
+            conn.execute(waveforms.delete().where(and_(waveforms.c.path == bindparam('dir_name'),
+                                                       waveforms.c.waveform_basename == bindparam('base_name'))),
+                         [{'dir_name': os.path.dirname(path), 'base_name': os.path.basename(path)} for path in batch])
+            conn.execute(archive_files.delete().where(archive_files.c.file_path == bindparam('old_path')),
+                         [{'old_path': path} for path in batch])
+
+        lookup = waveforms.select().with_only_columns(waveforms.c.waveform_basename, waveforms.c.path).where(
+            waveforms.c.waveform_basename.in_(bindparam('base_names', expanding=True)))
+        insert = waveforms.insert().prefix_with('OR REPLACE')
+        claimed = {}
+        for batch in batched(rows, batch_size):
+            stored_paths = {}
+            unclaimed = sorted(set(row['waveform_basename'] for row in batch) - set(claimed))
+            for base_names in batched(unclaimed, LOOKUP_BATCH_SIZE):
+                stored_paths.update((base_name, os.path.join(path, base_name))
+                                    for base_name, path in conn.execute(lookup, {'base_names': base_names}))
+            batch = drop_duplicate_basenames(batch, claimed, stored_paths, duplicates)
+            if batch:
+                conn.execute(insert, batch)
+
+        insert = archive_files.insert().prefix_with('OR REPLACE')
+        skipped = set(failed) | set(duplicates)
+        for batch in batched(sorted(item for item in fingerprints.items() if item[0] not in skipped), batch_size):
+            conn.execute(insert, [{'file_path': path, 'size': size, 'mtime': mtime}
+                                  for path, (size, mtime) in batch])
+    return len(claimed)
+
+
+def write_json(rows, json_filename, fingerprints, removed=(), replace_all=False, failed=(), duplicates=None):
+    """
+    Apply a scan to a {basename: entry} JSON database and its .files.json
+    fingerprint sidecar. Each file is replaced atomically and the sidecar is
+    written last, so an interrupted run leaves fingerprints that are at most
+    older than the database and the next incremental run rescans the
+    difference. Failed and duplicate paths are handled as by write_sqlite.
+    Returns the number of rows written
+    """
+    network_dict = {}
+    stored = {}
+    if not replace_all and os.path.exists(json_filename):
+        with open(json_filename, 'r') as f:
+            network_dict = json.load(f)
+        stored = read_fingerprints(json_filename)
+
+    for path in removed:
+        # the entry of the basename may belong to another file
+        entry = network_dict.get(os.path.basename(path))
+        if entry is not None and entry['path'] == os.path.dirname(path):
+            del network_dict[os.path.basename(path)]
+        stored.pop(path, None)
+
+    if duplicates is None:
+        duplicates = []
+    claimed = {}
+    for batch in batched(rows, INSERT_BATCH_SIZE):
+        stored_paths = dict((row['waveform_basename'], os.path.join(network_dict[row['waveform_basename']]['path'],
+                                                                    row['waveform_basename']))
+                            for row in batch
+                            if row['waveform_basename'] in network_dict and row['waveform_basename'] not in claimed)
+        for row in drop_duplicate_basenames(batch, claimed, stored_paths, duplicates):
+            row = dict(row)
+            network_dict[row.pop('waveform_basename')] = row
+    skipped = set(failed) | set(duplicates)
+    stored.update((path, fingerprint) for path, fingerprint in fingerprints.items() if path not in skipped)
+
+    for filename, data in [(json_filename, network_dict), (json_filename + '.files.json', stored)]:
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(data, f)
+        replace_file(filename + '.tmp', filename)
+    return len(claimed)
+
+
+def index_archive(archive_dir, db_filename, processes=None, new_network=None, pattern='*', incremental=False):
+    """
+    Scan a miniSEED archive into a .db or .json waveform database. With
+    incremental only files that are new or whose size/mtime changed since
+    the last run are scanned and deleted files are removed.
+    Files that can not be read or whose basename is already indexed for
+    another file are reported and left out of the stored fingerprints, so
+    the next incremental run scans them again.
+    Returns the (new, changed, deleted, not indexed) file path lists
+    """
+    start = time.time()
+    current = file_fingerprints(walk_archive(archive_dir, pattern))
+
+    if incremental:
+        new, changed, deleted = archive_delta(current, read_fingerprints(db_filename))
+    else:
+        new, changed, deleted = sorted(current), [], []
+
+    to_scan = new + changed
+    fingerprints = dict((path, current[path]) for path in to_scan)
+    failed = []
+    duplicates = []
+    rows = scan_files(to_scan, processes=processes, new_network=new_network, failed=failed)
+
+    if os.path.splitext(db_filename)[1] == ".json":
+        count = write_json(rows, db_filename, fingerprints, removed=changed + deleted, replace_all=not incremental,
+                           failed=failed, duplicates=duplicates)
+    else:
+        count = write_sqlite(rows, db_filename, fingerprints, removed=changed + deleted,
+                             replace_all=not incremental, failed=failed, duplicates=duplicates)
+
+    elapsed = time.time() - start
+    print("%s new, %s changed, %s deleted of %s files in the archive" % (
+        len(new), len(changed), len(deleted), len(current)))
+    print("Indexed %s files in %.1f s (%.0f files/s) with %s processes" % (
+        count, elapsed, len(to_scan) / max(elapsed, 1e-9), processes or multiprocessing.cpu_count()))
+    if failed:
+        print("%s files could not be read and will be retried by the next incremental run" % len(failed))
+    if duplicates:
+        print("%s files were not indexed as their basename is stored for another file" % len(duplicates))
+    return new, changed, deleted, failed + duplicates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the waveform database of a miniSEED archive")
+    parser.add_argument('archive_dir')
+    parser.add_argument('db_filename', help="output .db or .json database")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--network', default=None, help="network code written to new_network")
+    parser.add_argument('--pattern', default='*', help="filename pattern of the miniSEED files")
+    parser.add_argument('--incremental', action='store_true', help="only scan new, changed or deleted files")
+
+    args = parser.parse_args()
+
+    index_archive(args.archive_dir, args.db_filename, processes=args.processes, new_network=args.network,
+                  pattern=args.pattern, incremental=args.incremental)
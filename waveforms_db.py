@@ -1,5 +1,17 @@
-from sqlalchemy import Column, Integer, String
+"""
+SQL schema of the waveform database and the queries run against it.
+
+Usage:
+    python waveforms_db.py migrate DATABASE.db [--check]
+"""
+import argparse
+import re
+
+from sqlalchemy import Column, Integer, Float, String, Index
+from sqlalchemy import and_, or_, func, inspect, text
+from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
 
 # Set up the sql waveform databases
 Base = declarative_base()
@@ -7,6 +19,9 @@ Base = declarative_base()
 
 class Waveforms(Base):
     __tablename__ = 'waveforms'
+    # every query filters on station (and component) and a time window
+    __table_args__ = (Index('ix_waveforms_station_component_starttime', 'station', 'component', 'starttime'),
+                      Index('ix_waveforms_station_starttime', 'station', 'starttime'))
     # Here we define columns for the table
     starttime = Column(Integer)
     endtime = Column(Integer)
@@ -17,4 +32,113 @@ class Waveforms(Base):
     location = Column(String(2), nullable=False)
     waveform_basename = Column(String(40), nullable=False, primary_key=True)
     path = Column(String(100), nullable=False)
-    ASDF_tag = Column(String(100), nullable=False)
\ No newline at end of file
+    ASDF_tag = Column(String(100), nullable=False)
+
+
+class ArchiveFiles(Base):
+    # size/mtime fingerprint of every archive file scanned into the database
+    __tablename__ = 'archive_files'
+    file_path = Column(String(200), nullable=False, primary_key=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+
+
+def event_window_query(session, query_time, stations, components):
+    # waveforms recording at query_time or starting within 30 minutes after it
+    return session.query(Waveforms). \
+        filter(or_(and_(Waveforms.starttime <= query_time, query_time < Waveforms.endtime),
+                   and_(query_time <= Waveforms.starttime, Waveforms.starttime < query_time + 30 * 60)),
+               Waveforms.station.in_(stations),
+               Waveforms.component.in_(components))
+
+
+def station_extents_query(session):
+    # recording extents of the vertical components of all stations in one pass
+    return session.query(Waveforms.station, func.min(Waveforms.starttime), func.max(Waveforms.endtime)). \
+        filter(Waveforms.component.like('__Z')). \
+        group_by(Waveforms.station)
+
+
+def migrate_db(engine):
+    """
+    Create any indexes of the Waveforms schema missing from an existing
+    database, returns the names of the indexes created
+    """
+    existing = set(index['name'] for index in inspect(engine).get_indexes(Waveforms.__tablename__))
+
+    created = []
+    for index in Waveforms.__table__.indexes:
+        if index.name not in existing:
+            print("Creating index: " + index.name)
+            index.create(bind=engine)
+            created.append(index.name)
+
+    if created:
+        # refresh the statistics used by the query planner
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+
+    return created
+
+
+def explain_sql_plan(session, sql, params=None):
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params or {})
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def explain_query_plan(session, query):
+    statement = query.statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+    return explain_sql_plan(session, str(statement))
+
+
+def check_query_plans(session, station='XXXX', component='XXZ', query_time=0):
+    """
+    Assert via EXPLAIN QUERY PLAN that the waveform queries are answered
+    from an index rather than a full table scan. The gap queries may sort
+    their result (the gap and overlap rows) but have to read the Waveforms
+    table through the station/component/starttime index
+    """
+    from gap_engine import SQLITE_WINDOW_FUNCTIONS, WINDOW_GAPS_SQL, STATION_GAPS_SQL, INCREMENTAL_GAPS_SQL, \
+        CREATE_WATERMARKS_SQL
+
+    plans = [('event window', explain_query_plan(session, event_window_query(session, query_time, [station],
+                                                                                [component])), False),
+             ('station extents', explain_query_plan(session, station_extents_query(session)), False)]
+
+    if SQLITE_WINDOW_FUNCTIONS:
+        params = {'tolerance': 1, 'station': station}
+        session.connection().connection.execute(CREATE_WATERMARKS_SQL)
+        plans.extend([('window gaps', explain_sql_plan(session, WINDOW_GAPS_SQL, params), True),
+                      ('station gaps', explain_sql_plan(session, STATION_GAPS_SQL, params), True),
+                      ('incremental gaps', explain_sql_plan(session, INCREMENTAL_GAPS_SQL, params), True)])
+
+    for name, plan, sorts_result in plans:
+        print("%s: %s" % (name, '; '.join(plan)))
+        for detail in plan:
+            if re.match(r'SCAN (TABLE )?waveforms\b', detail) and 'INDEX' not in detail:
+                raise AssertionError("%s query scans the table: %s" % (name, detail))
+            if 'TEMP B-TREE' in detail and not sorts_result:
+                raise AssertionError("%s query sorts with a temporary b-tree: %s" % (name, detail))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Waveform database maintenance")
+    subparsers = parser.add_subparsers(dest='command')
+
+    migrate_parser = subparsers.add_parser('migrate', help="add missing indexes to an existing database")
+    migrate_parser.add_argument('db_filename')
+    migrate_parser.add_argument('--check', action='store_true', help="check the query plans use the indexes")
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        engine = create_engine('sqlite:///' + args.db_filename)
+        created = migrate_db(engine)
+        print("Created %s indexes" % len(created))
+        if args.check:
+            check_query_plans(sessionmaker(bind=engine)())
+            print("All waveform queries use an index")